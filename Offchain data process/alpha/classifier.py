@@ -0,0 +1,191 @@
+"""
+Batched relevance classification.
+
+Instead of one completion per message, pending messages are packed into a
+single numbered prompt and the model answers with one verdict (and a
+confidence) per item. A batch is sent as soon as it is full or when the
+oldest message has waited alpha_classify_max_wait seconds, whichever comes
+first, so latency stays bounded while requests per minute drop under load.
+
+A batch without a usable reply (an error or rate limit reply, or nothing
+parseable) is retried as a whole, and every worker holds off for an
+exponentially growing backoff first, so a throttling provider sees fewer
+requests rather than more. When the retries run out the items fail with
+BatchFailed and get no verdict at all.
+"""
+
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Queue
+
+from bridge.bridge import Bridge
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType
+from common import metrics
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+JSON_ARRAY_PATTERN = re.compile(r"\[.*\]", re.S)
+LINE_PATTERN = re.compile(r"^\s*\[?(\d+)\]?\s*[.:：、)\]]?\s*(是|否|yes|no)\b\s*[,，(（]?\s*([01](?:\.\d+)?)?", re.I | re.M)
+
+PROMPT = (
+    "你是{keyword}的专家。下面有{count}条编号的消息，请逐条判断它是否和{keyword}相关。\n"
+    '只输出一个JSON数组，不要输出其他内容，每条消息对应一个元素，格式为 {{"id": 编号, "relevant": "是" 或 "否", "confidence": 0到1之间的小数}}。\n\n'
+    "{items}"
+)
+
+
+class BatchFailed(Exception):
+    """the batch got no usable reply within alpha_classify_retries, its items have no verdict"""
+
+
+class BatchItem(object):
+    def __init__(self, text, keyword):
+        self.text = text
+        self.keyword = keyword
+        self.future = Future()
+
+
+def build_prompt(keyword, texts) -> str:
+    items = "\n".join("[{}] {}".format(i + 1, " ".join((text or "").split())) for i, text in enumerate(texts))
+    return PROMPT.format(keyword=keyword, count=len(texts), items=items)
+
+
+def parse_verdicts(reply, count) -> dict:
+    """
+    :return: {item index: (relevant, confidence)}, items the model skipped or garbled are missing
+    """
+    verdicts = {}
+    match = JSON_ARRAY_PATTERN.search(reply or "")
+    if match:
+        try:
+            for entry in json.loads(match.group()):
+                index = int(entry.get("id")) - 1
+                answer = str(entry.get("relevant", "")).strip().lower()
+                if 0 <= index < count and answer in ["是", "否", "yes", "no", "true", "false"]:
+                    verdicts[index] = (answer in ["是", "yes", "true"], float(entry.get("confidence", 1.0)))
+            return verdicts
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.debug("[Classifier] reply is not valid json, fall back to line parsing: {}".format(e))
+    # some models ignore the format and answer "1. 是 0.9" line by line
+    for index, answer, confidence in LINE_PATTERN.findall(reply or ""):
+        index = int(index) - 1
+        if 0 <= index < count:
+            verdicts[index] = (answer.lower() in ["是", "yes"], float(confidence) if confidence else 1.0)
+    return verdicts
+
+
+@singleton
+class BatchClassifier(object):
+    def __init__(self):
+        self.batch_size = max(1, conf().get("alpha_classify_batch_size", 10))
+        self.max_wait = conf().get("alpha_classify_max_wait", 1.0)
+        self.pending = Queue()
+        self.pool = ThreadPoolExecutor(max_workers=conf().get("alpha_classify_workers", 4), thread_name_prefix="classify")
+        self.retries = max(0, conf().get("alpha_classify_retries", 2))
+        self.backoff = conf().get("alpha_classify_retry_backoff", 2.0)
+        self.max_backoff = conf().get("alpha_classify_max_backoff", 60.0)
+        self.backoff_lock = threading.Lock()
+        self.backoff_until = 0.0  # no worker sends a request before this time.monotonic()
+        self.failures = 0  # consecutive failed requests
+        self.requests = 0
+        self.classified = 0
+        self.failed = 0
+        metrics.describe("alpha_classify_requests_total", "counter", "batched classification requests sent, retries included")
+        metrics.describe("alpha_classify_items_total", "counter", "batched messages by result: classified, skipped by the model or batch_failed")
+        _thread = threading.Thread(target=self._collect, name="classify-collector")
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def submit(self, text, keyword) -> Future:
+        """
+        :return: a future resolving to (relevant, confidence), or raising if the model gave no verdict for the item
+        """
+        item = BatchItem(text, keyword)
+        self.pending.put(item)
+        return item.future
+
+    def _collect(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except Empty:
+                    break
+            # one prompt can only ask about one keyword
+            by_keyword = {}
+            for item in batch:
+                by_keyword.setdefault(item.keyword, []).append(item)
+            for keyword, items in by_keyword.items():
+                self.pool.submit(self._classify, keyword, items)
+
+    def _classify(self, keyword, items):
+        items = [item for item in items if item.future.set_running_or_notify_cancel()]
+        if not items:
+            return
+        prompt = build_prompt(keyword, [item.text for item in items])
+        for attempt in range(self.retries + 1):
+            self._wait_backoff()
+            try:
+                verdicts = self._request(prompt, len(items))
+                break
+            except Exception as e:
+                delay = self._request_failed()
+                logger.warning("[Classifier] batch of {} failed (attempt {}/{}), backing off {:.1f}s: {}".format(len(items), attempt + 1, self.retries + 1, delay, e))
+                error = e
+        else:
+            self.failed += len(items)
+            metrics.inc("alpha_classify_items_total", len(items), result="batch_failed")
+            for item in items:
+                item.future.set_exception(BatchFailed(str(error)))
+            return
+        with self.backoff_lock:
+            self.failures = 0
+        logger.debug("[Classifier] classified {}/{} messages in one request".format(len(verdicts), len(items)))
+        self.classified += len(verdicts)
+        metrics.inc("alpha_classify_items_total", len(verdicts), result="classified")
+        if len(verdicts) < len(items):
+            metrics.inc("alpha_classify_items_total", len(items) - len(verdicts), result="skipped")
+        for index, item in enumerate(items):
+            if index in verdicts:
+                item.future.set_result(verdicts[index])
+            else:
+                item.future.set_exception(KeyError("no verdict for item {}".format(index + 1)))
+
+    def _request(self, prompt, count) -> dict:
+        # session_id None gives a throwaway session, so the batch prompt never lands in a conversation history
+        context = Context(ContextType.TEXT, prompt, kwargs={"session_id": None, "isgroup": False})
+        self.requests += 1
+        metrics.inc("alpha_classify_requests_total")
+        reply = Bridge().fetch_reply_content(prompt, context)
+        if reply is None or reply.type != ReplyType.TEXT:
+            raise Exception("classifier got no text reply: {}".format(reply))
+        verdicts = parse_verdicts(reply.content, count)
+        if not verdicts:
+            raise Exception("no verdict in the reply: {}".format(reply.content[:200]))
+        return verdicts
+
+    def _wait_backoff(self):
+        delay = self.backoff_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _request_failed(self) -> float:
+        """push the shared backoff out, :return: the new delay in seconds"""
+        with self.backoff_lock:
+            self.failures += 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+        return delay
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "classified": self.classified, "failed": self.failed, "pending": self.pending.qsize()}
@@ -0,0 +1,174 @@
+"""
+Columnar copy of the alpha dataset for analytics.
+
+Next to the json lines, the dataset sink can hand every record to a
+ColumnarWriter that keeps rolling Arrow IPC segments with typed columns.
+Arrow files can be memory-mapped, so a scan over the whole history reads
+the columns it needs straight from the page cache without parsing json.
+
+Segment files are named alpha-{first timestamp ms}-{last timestamp ms}.arrow,
+which lets a time bounded scan skip whole segments by name.
+
+Needs pyarrow (see requirements-optional.txt).
+"""
+
+import os
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+SEGMENT_PREFIX = "alpha-"
+SEGMENT_SUFFIX = ".arrow"
+
+
+def _schema():
+    return pa.schema(
+        [
+            ("timestamp", pa.timestamp("ms", tz="UTC")),
+            ("platform", pa.dictionary(pa.int16(), pa.string())),
+            ("author", pa.string()),
+            ("text", pa.string()),
+            ("url", pa.string()),
+            ("relevance", pa.float32()),
+            ("ocr", pa.bool_()),
+        ]
+    )
+
+
+def _columns(records) -> dict:
+    return {
+        "timestamp": [int(float(r.get("timestamp") or 0) * 1000) for r in records],
+        "platform": [r.get("platform") for r in records],
+        "author": [r.get("author") for r in records],
+        "text": [r.get("data") for r in records],
+        "url": [r.get("url") for r in records],
+        "relevance": [r.get("relevance") for r in records],
+        "ocr": [bool(r.get("ocr", False)) for r in records],
+    }
+
+
+def default_directory():
+    dataset_dir = conf().get("alpha_dataset_dir") or os.path.join(get_appdata_dir(), "dataset")
+    return conf().get("alpha_columnar_dir") or os.path.join(dataset_dir, "columnar")
+
+
+class ColumnarWriter(object):
+    def __init__(self, directory=None, segment_rows=None, segment_seconds=None):
+        if pa is None:
+            raise ImportError("pyarrow is required for the columnar dataset, pip install pyarrow")
+        self.directory = directory or default_directory()
+        self.segment_rows = segment_rows or conf().get("alpha_columnar_segment_rows", 50000)
+        self.segment_seconds = segment_seconds or conf().get("alpha_columnar_segment_seconds", 3600)
+        self.schema = _schema()
+        self.buffer = []
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def on_records(self, records):
+        with self.lock:
+            self.buffer.extend(records)
+            if len(self.buffer) >= self.segment_rows or time.monotonic() - self.started_at >= self.segment_seconds:
+                self._write_segment()
+
+    def close(self):
+        with self.lock:
+            self._write_segment()
+
+    def _write_segment(self):
+        # caller holds self.lock
+        if not self.buffer:
+            self.started_at = time.monotonic()
+            return
+        records, self.buffer = self.buffer, []
+        self.started_at = time.monotonic()
+        table = pa.Table.from_pydict(_columns(records), schema=self.schema).sort_by("timestamp")
+        timestamps = table.column("timestamp")
+        first, last = timestamps[0].value, timestamps[-1].value
+        path = os.path.join(self.directory, "{}{}-{}{}".format(SEGMENT_PREFIX, first, last, SEGMENT_SUFFIX))
+        sequence = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, "{}{}-{}-{}{}".format(SEGMENT_PREFIX, first, last, sequence, SEGMENT_SUFFIX))
+            sequence += 1
+        # write aside and rename, readers never see a half written segment
+        with pa.OSFile(path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, self.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + ".tmp", path)
+        logger.info("[Columnar] wrote {} rows to {}".format(table.num_rows, path))
+
+
+class ColumnarReader(object):
+    def __init__(self, directory=None):
+        if pa is None:
+            raise ImportError("pyarrow is required for the columnar dataset, pip install pyarrow")
+        self.directory = directory or default_directory()
+
+    def segments(self, since=None, until=None) -> list:
+        """
+        segment paths oldest first, optionally only those overlapping [since, until] (unix seconds)
+        """
+        paths = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+                continue
+            first, last = [int(part) for part in name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)].split("-")[:2]]
+            if since is not None and last < since * 1000:
+                continue
+            if until is not None and first > until * 1000:
+                continue
+            paths.append((first, os.path.join(self.directory, name)))
+        return [path for _, path in sorted(paths)]
+
+    def scan(self, columns=None, since=None, until=None):
+        """
+        yield one memory-mapped pyarrow table per segment, the data is only paged in when a column is touched
+        :param columns: column names to keep, None for all of them
+        """
+        import pyarrow.compute as pc
+
+        for path in self.segments(since, until):
+            # the map stays open as long as the table references it
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+            if since is not None or until is not None:
+                timestamps = table.column("timestamp").cast(pa.int64())
+                mask = None
+                if since is not None:
+                    mask = pc.greater_equal(timestamps, int(since * 1000))
+                if until is not None:
+                    upper = pc.less_equal(timestamps, int(until * 1000))
+                    mask = upper if mask is None else pc.and_(mask, upper)
+                table = table.filter(mask)
+            yield table.select(columns) if columns else table
+
+    def read_table(self, columns=None, since=None, until=None):
+        tables = list(self.scan(columns, since, until))
+        if not tables:
+            schema = _schema()
+            return schema.empty_table().select(columns) if columns else schema.empty_table()
+        return pa.concat_tables(tables)
+
+
+def backfill(paths, directory=None):
+    """convert existing json lines segments (see alpha.dataset.DatasetSink.segments) into columnar segments"""
+    from alpha.dataset import read_records
+
+    writer = ColumnarWriter(directory)
+    for path in paths:
+        batch = []
+        for record in read_records(path):
+            batch.append(record)
+            if len(batch) >= 10000:
+                writer.on_records(batch)
+                batch = []
+        if batch:
+            writer.on_records(batch)
+    writer.close()
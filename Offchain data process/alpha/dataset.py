@@ -0,0 +1,236 @@
+"""
+Append-only sink of the collected alpha dataset.
+
+Every channel hands its accepted messages to DatasetSink().write(). A single
+writer thread drains the queue in batches and appends them to the active
+segment as newline-delimited json, so each record is one line and a crash
+can at worst leave a partial last line, which is cut off on the next start.
+Segments are rotated by size or age and optionally gzip compressed.
+
+Only one process may write a dataset directory: repair and rotation are
+decided by the writer alone. The sink holds an exclusive lock on
+dataset.lock for as long as the process runs and refuses to start when
+another process holds it.
+
+fsync policy (alpha_dataset_fsync):
+    always   - fsync after every batch, nothing acknowledged is ever lost
+    interval - fsync at most every alpha_dataset_fsync_interval seconds
+    never    - leave it to the os
+"""
+
+import atexit
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from queue import Empty, Queue
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ACTIVE_SEGMENT = "dataset.jsonl"
+LOCK_FILE = "dataset.lock"
+MAX_BATCH = 512
+
+
+@singleton
+class DatasetSink(object):
+    def __init__(self):
+        self.directory = conf().get("alpha_dataset_dir") or os.path.join(get_appdata_dir(), "dataset")
+        self.fsync_policy = conf().get("alpha_dataset_fsync", "interval")
+        self.fsync_interval = conf().get("alpha_dataset_fsync_interval", 1.0)
+        self.rotate_bytes = conf().get("alpha_dataset_rotate_bytes", 64 * 1024 * 1024)
+        self.rotate_seconds = conf().get("alpha_dataset_rotate_seconds", 24 * 3600)
+        self.compress = conf().get("alpha_dataset_compress", True)
+        self.queue = Queue(maxsize=conf().get("alpha_dataset_queue_size", 10000))
+        # guards the active segment, rotation swaps the file underneath the writer
+        self.lock = threading.Lock()
+        self.written = 0
+        self.listeners = []
+        self.last_fsync = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, ACTIVE_SEGMENT)
+        self.lock_file = self._lock_directory()
+        self._repair()
+        self.file = open(self.path, "ab")
+        self.opened_at = time.time()
+        _thread = threading.Thread(target=self._drain, name="dataset-writer")
+        _thread.setDaemon(True)
+        _thread.start()
+        atexit.register(self.close)
+        logger.info("[Dataset] writing to {}, fsync={}".format(self.path, self.fsync_policy))
+        if conf().get("alpha_columnar_enabled", False):
+            from alpha.columnar import ColumnarWriter
+
+            self.add_listener(ColumnarWriter())
+        if conf().get("alpha_index_enabled", True):
+            from alpha.index import AlphaIndex
+
+            self.add_listener(AlphaIndex())
+
+    def add_listener(self, listener):
+        """
+        listener.on_records(records) is called from the writer thread after each batch is appended,
+        listener.close() when the sink is closed
+        """
+        self.listeners.append(listener)
+
+    def write(self, record: dict):
+        """queue a record, blocks while alpha_dataset_queue_size records are waiting for the writer"""
+        record.setdefault("timestamp", time.time())
+        self.queue.put(record)
+
+    def flush(self):
+        """wait until every queued record is on disk"""
+        self.queue.join()
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self.flush()
+            with self.lock:
+                self.file.close()
+            self.lock_file.close()
+        except Exception as e:
+            logger.warning("[Dataset] close failed: {}".format(e))
+        for listener in self.listeners:
+            try:
+                listener.close()
+            except Exception as e:
+                logger.warning("[Dataset] close listener {} failed: {}".format(listener, e))
+
+    def _lock_directory(self):
+        lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+        if fcntl is None:
+            logger.warning("[Dataset] no fcntl on this platform, make sure only one process writes to {}".format(self.directory))
+            return lock_file
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError("another process is writing the dataset in {}".format(self.directory))
+        return lock_file
+
+    def _repair(self):
+        # a crash mid-write leaves a line without its newline, cut it off so the file stays valid ndjson
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 1))
+            if f.read(1) == b"\n":
+                return
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            f.truncate(position)
+            logger.warning("[Dataset] dropped {} bytes of a partial record at the end of {}".format(size - position, self.path))
+
+    def _drain(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._append(batch)
+            except Exception as e:
+                logger.exception("[Dataset] write failed, {} records lost: {}".format(len(batch), e))
+            else:
+                for listener in self.listeners:
+                    try:
+                        listener.on_records(batch)
+                    except Exception as e:
+                        logger.exception("[Dataset] listener {} failed: {}".format(listener, e))
+            for _ in batch:
+                self.queue.task_done()
+
+    def _append(self, batch):
+        data = b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in batch)
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            now = time.monotonic()
+            if self.fsync_policy == "always" or (self.fsync_policy == "interval" and now - self.last_fsync >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                self.last_fsync = now
+            self.written += len(batch)
+            if self._should_rotate():
+                self._rotate()
+
+    def _should_rotate(self):
+        if self.rotate_bytes and self.file.tell() >= self.rotate_bytes:
+            return True
+        return bool(self.rotate_seconds) and time.time() - self.opened_at >= self.rotate_seconds and self.file.tell() > 0
+
+    def _rotate(self):
+        # caller holds self.lock
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.opened_at))
+        segment = os.path.join(self.directory, "dataset-{}.jsonl".format(stamp))
+        sequence = 1
+        while os.path.exists(segment) or os.path.exists(segment + ".gz"):
+            segment = os.path.join(self.directory, "dataset-{}-{}.jsonl".format(stamp, sequence))
+            sequence += 1
+        os.replace(self.path, segment)
+        self.file = open(self.path, "ab")
+        self.opened_at = time.time()
+        logger.info("[Dataset] rotated segment {}".format(segment))
+        if self.compress:
+            threading.Thread(target=_compress, args=(segment,), daemon=True).start()
+
+    def segments(self) -> list:
+        """closed segments oldest first, followed by the active one"""
+        names = set(os.listdir(self.directory))
+        # while a segment is being compressed both files exist, the plain one is removed right after
+        closed = sorted(
+            name for name in names if name.startswith("dataset-") and (name.endswith(".jsonl.gz") or (name.endswith(".jsonl") and name + ".gz" not in names))
+        )
+        return [os.path.join(self.directory, name) for name in closed] + [self.path]
+
+    def stats(self) -> dict:
+        return {"written": self.written, "queued": self.queue.qsize()}
+
+
+def _compress(segment):
+    try:
+        with open(segment, "rb") as src, gzip.open(segment + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(segment + ".gz.tmp", segment + ".gz")
+        os.remove(segment)
+    except Exception as e:
+        logger.warning("[Dataset] compress {} failed: {}".format(segment, e))
+
+
+def read_records(path):
+    """iterate the records of a plain or gzip compressed segment"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
@@ -0,0 +1,138 @@
+"""
+Inverted index over the collected alpha messages.
+
+The dataset sink feeds every appended batch to AlphaIndex, which stores the
+message once and a posting per term. Postings live in a WITHOUT ROWID table
+clustered by (term, timestamp), so "all messages mentioning X in the last N
+hours" is a single range scan per term no matter how many records there are.
+
+Terms are lower-cased words, $cashtags (also indexed without the $), EVM and
+Solana contract addresses, and character bigrams for chinese text, which has
+no word boundaries.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+WORD_PATTERN = re.compile(r"[a-z0-9_]{2,}")
+CASHTAG_PATTERN = re.compile(r"\$[a-z][a-z0-9]{1,9}\b")
+EVM_ADDRESS_PATTERN = re.compile(r"\b0x[0-9a-f]{40}\b")
+SOLANA_ADDRESS_PATTERN = re.compile(r"\b[1-9A-HJ-NP-Za-km-z]{32,44}\b")
+CJK_PATTERN = re.compile(r"[一-鿿]+")
+
+
+def tokenize(text) -> set:
+    text = text or ""
+    # solana addresses are case sensitive, pick them up before lower casing
+    terms = {address for address in SOLANA_ADDRESS_PATTERN.findall(text) if not address.isdigit()}
+    lowered = text.lower()
+    terms.update(EVM_ADDRESS_PATTERN.findall(lowered))
+    for cashtag in CASHTAG_PATTERN.findall(lowered):
+        terms.add(cashtag)
+        terms.add(cashtag[1:])
+    terms.update(WORD_PATTERN.findall(lowered))
+    for run in CJK_PATTERN.findall(lowered):
+        if len(run) == 1:
+            terms.add(run)
+        terms.update(run[i : i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def default_path():
+    dataset_dir = conf().get("alpha_dataset_dir") or os.path.join(get_appdata_dir(), "dataset")
+    return conf().get("alpha_index_path") or os.path.join(dataset_dir, "index.db")
+
+
+@singleton
+class AlphaIndex(object):
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = self._connect()
+        with self.lock:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    ts REAL NOT NULL,
+                    platform TEXT,
+                    author TEXT,
+                    text TEXT,
+                    url TEXT
+                );
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    PRIMARY KEY (term, ts, message_id)
+                ) WITHOUT ROWID;
+                """
+            )
+            self.conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # wal lets queries run while the writer thread is indexing
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def on_records(self, records):
+        with self.lock:
+            for record in records:
+                ts = float(record.get("timestamp") or time.time())
+                cursor = self.conn.execute(
+                    "INSERT INTO messages (ts, platform, author, text, url) VALUES (?, ?, ?, ?, ?)",
+                    (ts, record.get("platform"), record.get("author"), record.get("data"), record.get("url")),
+                )
+                message_id = cursor.lastrowid
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO postings (term, ts, message_id) VALUES (?, ?, ?)", [(term, ts, message_id) for term in tokenize(record.get("data"))]
+                )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def search(self, query, hours=24, limit=20) -> list:
+        """
+        messages mentioning every term of the query within the last `hours`, newest first
+        :return: list of dict with ts, platform, author, text and url
+        """
+        terms = sorted(tokenize(query))
+        if not terms:
+            return []
+        since = time.time() - hours * 3600
+        subquery = " INTERSECT ".join(["SELECT message_id FROM postings WHERE term = ? AND ts >= ?"] * len(terms))
+        params = []
+        for term in terms:
+            params.extend([term, since])
+        sql = "SELECT ts, platform, author, text, url FROM messages WHERE id IN ({}) ORDER BY ts DESC LIMIT ?".format(subquery)
+        with self.lock:
+            rows = self.conn.execute(sql, params + [limit]).fetchall()
+        return [{"ts": row[0], "platform": row[1], "author": row[2], "text": row[3], "url": row[4]} for row in rows]
+
+
+def search(query, hours=24, limit=20) -> list:
+    start = time.monotonic()
+    result = AlphaIndex().search(query, hours, limit)
+    logger.debug("[AlphaIndex] query={} hours={} hits={} cost={:.1f}ms".format(query, hours, len(result), (time.monotonic() - start) * 1000))
+    return result
+
+
+def format_results(results) -> str:
+    lines = []
+    for item in results:
+        when = time.strftime("%m-%d %H:%M", time.localtime(item["ts"]))
+        author = item["author"] or "-"
+        lines.append("[{}][{}] {}: {}".format(when, item["platform"], author, item["text"]))
+    return "\n".join(lines)
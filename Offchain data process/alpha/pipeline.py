@@ -0,0 +1,281 @@
+"""
+Ingestion engine shared by every alpha source.
+
+The Discord, Telegram and Feishu channels only turn what they receive into a
+Message and submit it; everything after that runs here, as a chain of stages:
+
+    fetch -> normalize -> ocr -> prefilter -> classify -> enrich -> sink
+
+Each stage has its own bounded queue and worker threads. A stage whose
+queue is full blocks the one before it, so back-pressure travels up to the
+source instead of piling messages up in memory. Worker counts and queue
+sizes come from alpha_pipeline_workers / alpha_pipeline_queue_size, so the
+usual bottlenecks (ocr, classify) are scaled in the config. With
+alpha_pipeline_processes the ocr stage runs in process shards instead of
+threads (see alpha.shards).
+
+Every stage reports alpha_stage_seconds and alpha_stage_messages_total per
+source, and alpha_messages_total counts the milestones of a message
+(received, media_failed, ocr, classified_yes/no, persisted, dropped,
+callback_failed, and shed by a source whose own queue was full); see
+common.metrics.
+"""
+
+import threading
+import time
+from queue import Queue
+
+from alpha.dataset import DatasetSink
+from alpha.prefilter import ACCEPT, CASHTAG_PATTERN, EVM_ADDRESS_PATTERN, REJECT
+from alpha.relevance import RelevanceFilter
+from alpha.shards import ShardPool
+from common import metrics
+from common.elastic_pool import ElasticThreadPool
+from common.log import logger
+from common.media import fetch_image
+from common.ocr import OcrEngine
+from common.singleton import singleton
+from common.throughput import ThroughputMeter
+from config import conf
+
+STAGES = ["fetch", "normalize", "ocr", "prefilter", "classify", "enrich", "sink"]
+DEFAULT_WORKERS = {"fetch": 4, "normalize": 1, "ocr": 2, "prefilter": 1, "classify": 8, "enrich": 1, "sink": 1}
+
+
+class Message(object):
+    """one collected message on its way through the stages"""
+
+    def __init__(
+        self, source, platform, keyword, text="", author=None, url=None, image=None, image_url=None, image_headers=None, ask=None, on_accepted=None, chat=None
+    ):
+        """
+        :param source: name of the channel the message came from, e.g. discord
+        :param platform: platform stored in the dataset, e.g. Twitter for tweets relayed to discord
+        :param image: image bytes already downloaded by the source, or a decoded RGB array
+        :param image_url: image the fetch stage downloads, with image_headers
+        :param ask: callable(text) -> bool asking the bot about this one message, see RelevanceFilter.classify
+        :param on_accepted: callable(message) run after a relevant message is stored, e.g. to forward it
+        :param chat: chat, channel or group id within the source
+        """
+        self.source = source
+        self.platform = platform
+        self.keyword = keyword
+        self.text = text or ""
+        self.author = author
+        self.url = url
+        self.image = image
+        self.image_url = image_url
+        self.image_headers = image_headers
+        self.ask = ask
+        self.on_accepted = on_accepted
+        self.chat = chat
+        self.ocr = False
+        self.relevant = None
+        self.relevance = None
+        self.record = None
+        self.created_at = time.monotonic()
+
+
+class Stage(object):
+    def __init__(self, name, handler, workers, queue_size):
+        """
+        :param handler: callable(message) -> message to pass on, or None to drop it
+        """
+        self.name = name
+        self.handler = handler
+        self.worker_count = max(1, workers)
+        self.queue = Queue(maxsize=queue_size)
+        self.next = None
+        self.lock = threading.Lock()
+        self.received = 0
+        self.passed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy = 0.0  # seconds spent in the handler
+
+    def start(self):
+        for i in range(self.worker_count):
+            _thread = threading.Thread(target=self._work, name="pipeline-{}-{}".format(self.name, i))
+            _thread.setDaemon(True)
+            _thread.start()
+
+    def put(self, message):
+        """blocks while the stage queue is full"""
+        self.queue.put(message)
+
+    def _work(self):
+        while True:
+            message = self.queue.get()
+            start = time.monotonic()
+            try:
+                result = self.handler(message)
+                failed = False
+            except Exception as e:
+                logger.exception("[Pipeline] stage {} failed on a {} message: {}".format(self.name, message.source, e))
+                result, failed = None, True
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.received += 1
+                self.busy += elapsed
+                if failed:
+                    self.failed += 1
+                    outcome = "failed"
+                elif result is None:
+                    self.dropped += 1
+                    outcome = "dropped"
+                else:
+                    self.passed += 1
+                    outcome = "passed"
+            metrics.observe("alpha_stage_seconds", elapsed, stage=self.name, source=message.source)
+            metrics.inc("alpha_stage_messages_total", stage=self.name, source=message.source, outcome=outcome)
+            if result is None:
+                metrics.inc("alpha_messages_total", source=message.source, event="dropped")
+            self.queue.task_done()
+            if result is not None and self.next is not None:
+                self.next.put(result)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.worker_count,
+                "queued": self.queue.qsize(),
+                "received": self.received,
+                "passed": self.passed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "avg_ms": round(self.busy * 1000 / self.received, 1) if self.received else 0.0,
+            }
+
+
+@singleton
+class IngestionEngine(object):
+    def __init__(self):
+        workers = dict(DEFAULT_WORKERS)
+        workers.update(conf().get("alpha_pipeline_workers", {}))
+        queue_size = conf().get("alpha_pipeline_queue_size", 1000)
+        self.shards = None
+        processes = conf().get("alpha_pipeline_processes", 0)
+        if processes > 0:
+            self.shards = ShardPool(processes, conf().get("alpha_pipeline_start_method", "spawn"))
+            # each ocr thread waits on one shard, keep enough of them to have every shard busy
+            workers["ocr"] = max(workers.get("ocr", 1), processes * 2)
+        if conf().get("alpha_classify_batch_enabled", True):
+            # each classify thread waits on one batched verdict, with fewer threads than a batch holds no batch
+            # ever fills and every request waits alpha_classify_max_wait; keep enough to fill every request in flight
+            batch_size = max(1, conf().get("alpha_classify_batch_size", 10))
+            workers["classify"] = max(workers.get("classify", 1), batch_size * max(1, conf().get("alpha_classify_workers", 4)))
+        self.stages = [Stage(name, getattr(self, "_" + name), workers.get(name, 1), queue_size) for name in STAGES]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.sources = {}  # source name -> submitted messages
+        self.sources_lock = threading.Lock()
+        self.throughput = ThroughputMeter()
+        # on_accepted callbacks (e.g. forwarding to a chat) call other services, they must not hold up the sink worker
+        self.callbacks = ElasticThreadPool(min_workers=0, max_workers=conf().get("alpha_pipeline_callback_workers", 4), name="alpha_callback")
+        metrics.describe("alpha_stage_seconds", "histogram", "time a message spent in an ingestion stage handler")
+        metrics.describe("alpha_stage_messages_total", "counter", "messages handled per ingestion stage, source and outcome")
+        metrics.describe("alpha_messages_total", "counter", "ingestion milestones per source")
+        metrics.describe("alpha_ingest_lag_seconds", "histogram", "time from submit to persisted per source")
+        metrics.gauge("alpha_stage_queue_depth", lambda: {(("stage", stage.name),): stage.queue.qsize() for stage in self.stages}, "messages waiting per stage")
+        for stage in self.stages:
+            stage.start()
+        logger.info("[Pipeline] started, workers={}".format({stage.name: stage.worker_count for stage in self.stages}))
+
+    def submit(self, message: Message):
+        """hand a message to the first stage, blocks while that stage is full"""
+        with self.sources_lock:
+            self.sources[message.source] = self.sources.get(message.source, 0) + 1
+        metrics.inc("alpha_messages_total", source=message.source, event="received")
+        self.stages[0].put(message)
+
+    def stats(self) -> dict:
+        with self.sources_lock:
+            sources = dict(self.sources)
+        stats = {
+            "sources": sources,
+            "stored_per_second": round(self.throughput.rate(), 2),
+            "stages": {stage.name: stage.stats() for stage in self.stages},
+        }
+        if self.shards is not None:
+            stats["shards"] = self.shards.stats()
+        return stats
+
+    def _fetch(self, message: Message):
+        if message.image is None and message.image_url:
+            # decoded here once, ocr gets the pixels as they are
+            try:
+                message.image = fetch_image(message.image_url, headers=message.image_headers)
+            except Exception as e:
+                # the text is still worth classifying, normalize drops the message if there is none
+                metrics.inc("alpha_messages_total", source=message.source, event="media_failed")
+                logger.warning("[Pipeline] cannot fetch the image of a {} message, going on with its text: {}".format(message.source, e))
+        return message
+
+    def _normalize(self, message: Message):
+        message.text = " ".join(message.text.split())
+        if not message.text and message.image is None:
+            return None
+        return message
+
+    def _ocr(self, message: Message):
+        if self.shards is not None:
+            message.ocr = message.image is not None
+            message.text = self.shards.recognize(message.text, message.image).result()
+            message.image = None
+        elif message.image is not None:
+            recognized = OcrEngine().recognize(message.image)
+            message.text = (message.text + " " + recognized).strip() if recognized else message.text
+            message.image = None  # the pixels are not needed any more
+            message.ocr = True
+        if message.ocr:
+            metrics.inc("alpha_messages_total", source=message.source, event="ocr")
+        return message if message.text else None
+
+    def _prefilter(self, message: Message):
+        decision = RelevanceFilter().prefilter(message.text, message.keyword)
+        if decision == REJECT:
+            metrics.inc("alpha_messages_total", source=message.source, event="prefilter_rejected")
+            return None
+        if decision == ACCEPT:
+            message.relevant, message.relevance = True, 1.0
+            metrics.inc("alpha_messages_total", source=message.source, event="prefilter_accepted")
+        return message
+
+    def _classify(self, message: Message):
+        if message.relevant is None:
+            message.relevant, message.relevance = RelevanceFilter().classify(message.text, message.keyword, message.ask)
+            metrics.inc("alpha_messages_total", source=message.source, event="classified_yes" if message.relevant else "classified_no")
+        return message if message.relevant else None
+
+    def _enrich(self, message: Message):
+        lowered = message.text.lower()
+        message.record = {
+            'url': message.url,
+            'data': message.text,
+            'platform': message.platform,
+            'author': message.author,
+            'relevance': message.relevance,
+            'ocr': message.ocr,
+            'source': message.source,
+            'tickers': sorted({tag[1:].upper() for tag in CASHTAG_PATTERN.findall(lowered)}),
+            'addresses': sorted(set(EVM_ADDRESS_PATTERN.findall(lowered))),
+        }
+        return message
+
+    def _sink(self, message: Message):
+        DatasetSink().write(message.record)
+        self.throughput.mark()
+        lag = time.monotonic() - message.created_at
+        metrics.inc("alpha_messages_total", source=message.source, event="persisted")
+        metrics.observe("alpha_ingest_lag_seconds", lag, source=message.source)
+        logger.debug("[Pipeline] stored a {} message after {:.0f}ms".format(message.source, lag * 1000))
+        if message.on_accepted is not None:
+            self.callbacks.submit(self._on_accepted, message)
+        return message
+
+    def _on_accepted(self, message: Message):
+        try:
+            message.on_accepted(message)
+        except Exception as e:
+            metrics.inc("alpha_messages_total", source=message.source, event="callback_failed")
+            logger.warning("[Pipeline] on_accepted of a {} message failed: {}".format(message.source, e))
@@ -0,0 +1,169 @@
+"""
+Cheap local scoring that runs before the LLM relevance check.
+
+All watched words (the keyword itself, tickers, contract addresses, related
+terms and spam phrases) go into one Aho-Corasick automaton, so a message is
+scanned once no matter how many words are configured. Strong hits (an
+accept word, or the keyword together with another signal) are accepted,
+messages with spam phrases are dropped, and everything in between, including
+a bare keyword mention, is sent to the model. Messages that match nothing
+at all are dropped unless reject_without_signal is turned off, so only the
+few messages with some signal cost a model call.
+"""
+
+import importlib.util
+import os
+import re
+import threading
+
+from common.log import logger
+from config import conf, get_root
+
+
+def _load_words_search():
+    # importing through the plugins.banwords package would register the banwords plugin outside of the plugin manager
+    path = os.path.join(get_root(), "plugins", "banwords", "lib", "WordsSearch.py")
+    spec = importlib.util.spec_from_file_location("alpha_words_search", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.WordsSearch
+
+
+WordsSearch = _load_words_search()
+
+ACCEPT = "accept"
+REJECT = "reject"
+UNSURE = "unsure"
+
+CASHTAG_PATTERN = re.compile(r"\$[a-z][a-z0-9]{1,9}\b")
+EVM_ADDRESS_PATTERN = re.compile(r"\b0x[0-9a-f]{40}\b")
+# a latin word or number, or a single cjk character, which carries about as much as a word
+WORD_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+
+DEFAULT_RULES = {
+    # tickers, project names or contract addresses that are always relevant; the defaults are phrases that announce one
+    "accept_words": ["contract address", "合约地址", "will list", "listing announcement", "上币公告"],
+    # weak signals, a message with one of them (or the keyword, a $TICKER or an address) is worth asking the model about
+    "related_words": [
+        "airdrop",
+        "mainnet",
+        "testnet",
+        "listing",
+        "launch",
+        "tge",
+        "presale",
+        "whitelist",
+        "snapshot",
+        "staking",
+        "token",
+        "空投",
+        "主网",
+        "测试网",
+        "上线",
+        "白名单",
+        "快照",
+        "质押",
+        "代币",
+    ],
+    # spam phrases, a message containing one is dropped
+    "reject_words": [
+        "giveaway",
+        "dm me",
+        "double your",
+        "guaranteed profit",
+        "send eth to",
+        "join our vip",
+        "whatsapp",
+        "免费领取",
+        "加微信",
+        "私聊领取",
+        "稳赚",
+        "带单",
+    ],
+    "accept_score": 3,  # score at which a message is accepted without asking the model
+    "keyword_score": 2,  # score of the hunted keyword itself, below accept_score so a bare mention still goes to the model
+    "accept_word_score": 3,
+    "related_word_score": 1,
+    "cashtag_score": 1,  # any $TICKER
+    "address_score": 1,  # any evm contract address
+    "min_length": 2,  # messages with fewer words are dropped, every cjk character counts as a word
+    "reject_without_signal": True,  # drop messages that score 0 instead of asking the model, False sends them to the model too
+}
+
+
+def word_count(text) -> int:
+    return len(WORD_PATTERN.findall(text or ""))
+
+
+class PreFilter(object):
+    def __init__(self, keyword, rules=None):
+        self.rules = dict(DEFAULT_RULES)
+        self.rules.update(rules or {})
+        self.weights = {}
+        self.rejects = set()
+        for word, weight in [(keyword, self.rules["keyword_score"])] + [(w, self.rules["accept_word_score"]) for w in self.rules["accept_words"]] + [
+            (w, self.rules["related_word_score"]) for w in self.rules["related_words"]
+        ]:
+            word = (word or "").strip().lower()
+            if word:
+                self.weights[word] = max(weight, self.weights.get(word, 0))
+        for word in self.rules["reject_words"]:
+            word = (word or "").strip().lower()
+            if word:
+                self.rejects.add(word)
+                self.weights.pop(word, None)
+        self.searcher = WordsSearch()
+        self.searcher.SetKeywords(list(self.weights.keys()) + sorted(self.rejects))
+
+    def score(self, text):
+        """
+        :return: (score, matched words), score is None if the message hit a reject word
+        """
+        text = (text or "").lower()
+        matched = {hit["Keyword"] for hit in self.searcher.FindAll(text)} if text else set()
+        if matched & self.rejects:
+            return None, matched
+        score = sum(self.weights[word] for word in matched)
+        if CASHTAG_PATTERN.search(text):
+            score += self.rules["cashtag_score"]
+        if EVM_ADDRESS_PATTERN.search(text):
+            score += self.rules["address_score"]
+        return score, matched
+
+    def check(self, text) -> str:
+        if word_count(text) < self.rules["min_length"]:
+            return REJECT
+        score, matched = self.score(text)
+        if score is None:
+            logger.debug("[PreFilter] reject word matched: {}".format(matched))
+            return REJECT
+        if score >= self.rules["accept_score"]:
+            return ACCEPT
+        if score == 0 and self.rules["reject_without_signal"]:
+            return REJECT
+        return UNSURE
+
+
+class PreFilters(object):
+    """one automaton per hunted keyword, built on first use"""
+
+    def __init__(self):
+        self.filters = {}
+        self.lock = threading.Lock()
+        self.counts = {ACCEPT: 0, REJECT: 0, UNSURE: 0}
+
+    def check(self, text, keyword) -> str:
+        prefilter = self.filters.get(keyword)
+        if prefilter is None:
+            with self.lock:
+                prefilter = self.filters.get(keyword)
+                if prefilter is None:
+                    prefilter = PreFilter(keyword, conf().get("alpha_prefilter_rules", {}))
+                    self.filters[keyword] = prefilter
+        decision = prefilter.check(text)
+        with self.lock:
+            self.counts[decision] += 1
+        return decision
+
+    def stats(self) -> dict:
+        return dict(self.counts)
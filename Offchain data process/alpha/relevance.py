@@ -0,0 +1,280 @@
+"""
+Relevance verdict cache for the alpha keyword filter.
+
+Every message the Discord, Telegram and Feishu channels collect is judged by
+the chat bot ("is this related to {keyword}?"). Feeds repeat themselves a lot:
+retweets, forwards and cross-posts carry the same text with a different
+prefix, link or emoji. Verdicts are therefore cached by normalized text and
+keyword, and near duplicates are found with MinHash signatures over character
+shingles, bucketed with LSH so a lookup only compares a handful of candidates.
+
+Before any of that, a local pre-filter (see alpha.prefilter) settles the
+obvious cases so most messages never reach the cache or the model. What is
+left is classified in batches (see alpha.classifier). Only the messages a
+good batch reply skipped are asked about one by one, at most
+alpha_classify_max_fallbacks per minute; a batch that failed as a whole
+leaves its messages without a verdict instead of multiplying the requests.
+"""
+
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from alpha.classifier import BatchClassifier, BatchFailed
+from alpha.prefilter import ACCEPT, REJECT, UNSURE, PreFilters
+from common import metrics
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+URL_PATTERN = re.compile(r"(https?|ftp)://\S+")
+RETWEET_PATTERN = re.compile(r"^(rt\s+)?@\w+\s*:\s*")
+NON_WORD_PATTERN = re.compile(r"[^\w]+")
+
+# 61 bit mersenne prime, the permutations are (a * x + b) % MERSENNE_PRIME
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize_text(text: str) -> str:
+    """lower case, strip links and retweet prefixes, collapse punctuation and whitespace"""
+    text = URL_PATTERN.sub(" ", (text or "").lower())
+    text = RETWEET_PATTERN.sub("", text.strip())
+    return " ".join(NON_WORD_PATTERN.sub(" ", text).split())
+
+
+def shingles(text: str, size=4) -> set:
+    # character shingles work for chinese, which has no word boundaries, as well as for english
+    if len(text) <= size:
+        return {text}
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHasher(object):
+    def __init__(self, num_perm=64, seed=1):
+        rand = random.Random(seed)
+        self.num_perm = num_perm
+        self.permutations = [(rand.randrange(1, MERSENNE_PRIME), rand.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+
+    def signature(self, features) -> tuple:
+        hashes = [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "big") for f in features]
+        return tuple(min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self.permutations)
+
+
+def similarity(sig_a, sig_b) -> float:
+    """estimated jaccard similarity of two minhash signatures"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class RelevanceCache(object):
+    def __init__(self, ttl=3600, threshold=0.8, num_perm=64, bands=16, max_entries=50000):
+        assert num_perm % bands == 0, "num_perm must be a multiple of bands"
+        self.ttl = ttl
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.hasher = MinHasher(num_perm)
+        self.entries = OrderedDict()  # key -> (verdict, signature, bucket keys, expires_at), oldest first
+        self.buckets = {}  # (keyword, band, band values) -> set of keys
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.describe("alpha_relevance_cache_total", "counter", "relevance cache lookups by result: exact_hit, near_hit or miss")
+        metrics.describe("alpha_relevance_cache_evictions_total", "counter", "relevance verdicts dropped by age or size")
+        metrics.gauge("alpha_relevance_cache_entries", lambda: len(self.entries), "relevance verdicts in the cache")
+
+    def _key(self, normalized, keyword):
+        return hashlib.sha1("{}\0{}".format(keyword, normalized).encode("utf-8")).hexdigest()
+
+    def _bucket_keys(self, signature, keyword):
+        return [(keyword, band, signature[band * self.rows : (band + 1) * self.rows]) for band in range(self.bands)]
+
+    def lookup(self, text, keyword):
+        """
+        :return: the cached verdict of the same or a near duplicate text, None if there is none
+        """
+        normalized = normalize_text(text)
+        key = self._key(normalized, keyword)
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.exact_hits += 1
+                metrics.inc("alpha_relevance_cache_total", result="exact_hit")
+                return entry[0]
+        signature = self.hasher.signature(shingles(normalized))
+        with self.lock:
+            candidates = set()
+            for bucket_key in self._bucket_keys(signature, keyword):
+                candidates.update(self.buckets.get(bucket_key, ()))
+            best, best_score = None, 0.0
+            for candidate in candidates:
+                entry = self.entries.get(candidate)
+                if entry is None:
+                    continue
+                score = similarity(signature, entry[1])
+                if score > best_score:
+                    best, best_score = entry, score
+            if best is not None and best_score >= self.threshold:
+                self.near_hits += 1
+                metrics.inc("alpha_relevance_cache_total", result="near_hit")
+                logger.debug("[Relevance] near duplicate hit, similarity={:.2f}".format(best_score))
+                return best[0]
+            self.misses += 1
+            metrics.inc("alpha_relevance_cache_total", result="miss")
+            return None
+
+    def store(self, text, keyword, verdict):
+        normalized = normalize_text(text)
+        key = self._key(normalized, keyword)
+        signature = self.hasher.signature(shingles(normalized))
+        bucket_keys = self._bucket_keys(signature, keyword)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (verdict, signature, bucket_keys, time.monotonic() + self.ttl)
+            for bucket_key in bucket_keys:
+                self.buckets.setdefault(bucket_key, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self._evicted()
+
+    def _remove(self, key):
+        # caller holds self.lock
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for bucket_key in entry[2]:
+            bucket = self.buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[bucket_key]
+
+    def _expire(self):
+        # entries are kept in insertion order and share one ttl, so the expired ones are always at the front
+        now = time.monotonic()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry[3] > now:
+                break
+            self._remove(key)
+            self._evicted()
+
+    def _evicted(self):
+        # caller holds self.lock
+        self.evictions += 1
+        metrics.inc("alpha_relevance_cache_evictions_total")
+
+    def stats(self) -> dict:
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+
+@singleton
+class RelevanceFilter(object):
+    """shared entry point of the channels, it only asks the bot when no earlier verdict can be reused"""
+
+    def __init__(self):
+        self.prefilters = PreFilters() if conf().get("alpha_prefilter_enabled", True) else None
+        self.cache = None
+        if conf().get("relevance_cache_enabled", True):
+            self.cache = RelevanceCache(
+                ttl=conf().get("relevance_cache_ttl", 3600),
+                threshold=conf().get("relevance_similarity_threshold", 0.8),
+                max_entries=conf().get("relevance_cache_max_entries", 50000),
+            )
+        self.batcher = BatchClassifier() if conf().get("alpha_classify_batch_enabled", True) else None
+        self.min_confidence = conf().get("alpha_classify_min_confidence", 0.5)
+        self.max_fallbacks = conf().get("alpha_classify_max_fallbacks", 20)
+        self.fallback_lock = threading.Lock()
+        self.fallback_window = 0  # minute of time.monotonic() the fallbacks are counted in
+        self.fallbacks = 0
+        metrics.describe("alpha_classify_fallbacks_total", "counter", "skipped messages asked about one by one, or capped by alpha_classify_max_fallbacks")
+
+    def is_relevant(self, text, keyword, classify) -> bool:
+        """
+        :param text: message text, including any ocr output
+        :param keyword: the keyword the channel is hunting for
+        :param classify: callable(text) -> bool that asks the bot about this one message, used on a cache miss
+                         when batching is off or an otherwise good batch reply skipped the message
+        """
+        return self.judge(text, keyword, classify)[0]
+
+    def judge(self, text, keyword, classify):
+        """
+        same as is_relevant, but also returns how confident the verdict is
+        :return: (relevant, confidence between 0 and 1)
+        """
+        decision = self.prefilter(text, keyword)
+        if decision == ACCEPT:
+            return True, 1.0
+        if decision == REJECT:
+            return False, 1.0
+        return self.classify(text, keyword, classify)
+
+    def prefilter(self, text, keyword) -> str:
+        """the local verdict alone: ACCEPT, REJECT or UNSURE (always UNSURE when the pre-filter is disabled)"""
+        if self.prefilters is None:
+            return UNSURE
+        return self.prefilters.check(text, keyword)
+
+    def classify(self, text, keyword, classify):
+        """
+        the model verdict for a message the pre-filter was unsure about, reused from the cache when possible
+        :return: (relevant, confidence between 0 and 1), (False, 0.0) when the model could not be asked
+        """
+        if self.cache is not None:
+            verdict = self.cache.lookup(text, keyword)
+            if verdict is not None:
+                return verdict
+        verdict, confidence = self._classify(text, keyword, classify)
+        # unsure answers are not worth reusing for the duplicates
+        if self.cache is not None and confidence >= self.min_confidence:
+            self.cache.store(text, keyword, (verdict, confidence))
+        return verdict, confidence
+
+    def _classify(self, text, keyword, classify):
+        if self.batcher is not None:
+            try:
+                return self.batcher.submit(text, keyword).result()
+            except BatchFailed as e:
+                # asking message by message would only multiply the requests a throttling provider refused
+                logger.debug("[Relevance] batch classification failed, no verdict: {}".format(e))
+                return False, 0.0
+            except KeyError as e:
+                if not self._allow_fallback():
+                    metrics.inc("alpha_classify_fallbacks_total", result="capped")
+                    logger.debug("[Relevance] {}, single message fallbacks are used up for this minute".format(e))
+                    return False, 0.0
+                metrics.inc("alpha_classify_fallbacks_total", result="asked")
+        return classify(text), 1.0
+
+    def _allow_fallback(self) -> bool:
+        window = int(time.monotonic() // 60)
+        with self.fallback_lock:
+            if window != self.fallback_window:
+                self.fallback_window, self.fallbacks = window, 0
+            if self.fallbacks >= self.max_fallbacks:
+                return False
+            self.fallbacks += 1
+            return True
+
+    def stats(self) -> dict:
+        stats = {}
+        if self.prefilters is not None:
+            stats.update({"prefilter_" + k: v for k, v in self.prefilters.stats().items()})
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        if self.batcher is not None:
+            stats.update({"classify_" + k: v for k, v in self.batcher.stats().items()})
+        return stats
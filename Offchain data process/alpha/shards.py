@@ -0,0 +1,87 @@
+"""
+Process shards for the CPU bound part of ingestion.
+
+OCR and text clean-up hold the GIL, so more threads in one process do not
+use more cores. With alpha_pipeline_processes > 0 the ingestion engine sends
+that work to a set of single-process shards instead, each keeping its own
+ocr model loaded. Every message goes to the shard with the fewest messages
+in flight. Nearly all traffic comes from one chat (the TweetShift channel on
+Discord), so pinning chats to shards would leave all but one core idle; the
+stages around the shards are multi-threaded anyway, so per-chat order is not
+kept either way.
+
+Only the text comes back; classification and the dataset sink keep running
+in the parent, so every shard ends up in the same dataset.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+from common.log import logger
+
+
+def _init_shard(settings):
+    # spawned shards start from a blank config, use the parent's settings instead of reloading config.json
+    config.config = config.Config(settings)
+
+
+def _recognize(text, image):
+    """runs inside a shard: ocr the image and append the result to the normalized text"""
+    from common.ocr import OcrEngine
+
+    text = " ".join((text or "").split())
+    recognized = " ".join(OcrEngine().recognize(image).split()) if image is not None else ""
+    return (text + " " + recognized).strip() if recognized else text
+
+
+class ShardPool(object):
+    def __init__(self, processes, start_method="spawn"):
+        """
+        :param start_method: multiprocessing start method, spawn by default because forking a process full of threads is unsafe
+        """
+        self.context = multiprocessing.get_context(start_method)
+        self.settings = dict(config.conf())
+        # a shard only ever has one image in flight, waiting for a batch to fill would just add latency
+        self.settings["ocr_batch_size"] = 1
+        self.settings["ocr_workers"] = 1
+        self.lock = threading.Lock()
+        self.shards = [self._new_shard() for _ in range(processes)]
+        self.counts = [0] * processes
+        self.in_flight = [0] * processes
+        logger.info("[Shards] started {} ingestion processes ({})".format(processes, start_method))
+
+    def _new_shard(self):
+        return ProcessPoolExecutor(max_workers=1, mp_context=self.context, initializer=_init_shard, initargs=(self.settings,))
+
+    def recognize(self, text, image) -> Future:
+        """
+        :return: a future resolving to the normalized text including the ocr output
+        """
+        with self.lock:
+            index = min(range(len(self.shards)), key=lambda i: self.in_flight[i])
+            self.counts[index] += 1
+            self.in_flight[index] += 1
+            try:
+                future = self.shards[index].submit(_recognize, text, image)
+            except BrokenProcessPool:
+                # the process died (e.g. killed for memory), replace it so the shard keeps serving
+                logger.warning("[Shards] shard {} died, starting a new process".format(index))
+                self.shards[index] = self._new_shard()
+                future = self.shards[index].submit(_recognize, text, image)
+        future.add_done_callback(lambda f, index=index: self._done(index))
+        return future
+
+    def _done(self, index):
+        with self.lock:
+            self.in_flight[index] -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"shard_{}".format(i): {"handled": count, "in_flight": self.in_flight[i]} for i, count in enumerate(self.counts)}
+
+    def shutdown(self):
+        for shard in self.shards:
+            shard.shutdown(wait=False)
@@ -5,7 +5,7 @@ import signal
 import sys
 
 from channel import channel_factory
-from common import const
+from common import const, metrics, token_counter
 from config import load_config
 from plugins import *
 import threading
@@ -33,6 +33,10 @@ def run():
         # kill signal
         sigterm_handler_wrap(signal.SIGTERM)
 
+        # load the tokenizers in the background, not on the first reply
+        if conf().get("token_counter_warmup", True):
+            token_counter.warm()
+
         # create channel
         channel_name = conf().get("channel_type", "wx")
 
@@ -54,6 +58,9 @@ def run():
             except Exception as e:
                 pass
 
+        # prometheus style metrics on metrics_port
+        metrics.start_server()
+
         # startup channel
         channel.startup()
 
@@ -5,6 +5,7 @@ Auto-replay chat robot abstract class
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.async_core import run_sync
 
 
 class Bot(object):
@@ -15,3 +16,10 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        """
+        coroutine version of reply used by the async core, bots with an async client override it
+        by default the synchronous reply runs on the async core executor
+        """
+        return await run_sync(self.reply, query, context)
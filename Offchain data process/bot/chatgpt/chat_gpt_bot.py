@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -12,11 +13,15 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.async_core import AsyncCore, run_sync
 from common.log import logger
 from common.token_bucket import TokenBucket
 from config import conf, load_config
 
 
+SUMMARY_PROMPT = "你负责压缩对话记录。把新的对话合并进已有摘要，保留用户的身份、偏好、提到的事实、数字和尚未解决的问题，去掉寒暄和重复内容，只输出新的摘要。"
+
+
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
     def __init__(self):
@@ -32,6 +37,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
 
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        self.sessions.summarizer = self.summarize
         self.args = {
             "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
@@ -46,53 +52,11 @@ class ChatGPTBot(Bot, OpenAIImage):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session, api_key, new_args = self._prepare_text(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
             reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._text_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -106,6 +70,94 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def async_reply(self, query, context=None):
+        # 只有文本对话走异步接口，其余类型仍在线程池中执行同步逻辑
+        if context.type != ContextType.TEXT:
+            return await super().async_reply(query, context)
+        # 会话的读写会计算token、访问sqlite或redis, 放到线程池里, 不能阻塞事件循环
+        reply, session, api_key, new_args = await run_sync(self._prepare_text, query, context)
+        if reply:
+            return reply
+        reply_content = await self.async_reply_text(session, api_key, args=new_args)
+        return await run_sync(self._text_reply, session, reply_content)
+
+    def _prepare_text(self, query, context):
+        """
+        handle the memory commands and build the session of a text query
+        :return: (reply of a command or None, session, api_key, args overriding self.args or None)
+        """
+        logger.info("[CHATGPT] query={}".format(query))
+
+        session_id = context["session_id"]
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        if reply:
+            return reply, None, None, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        # if context.get('stream'):
+        #     # reply in stream
+        #     return self.reply_text_stream(query, new_query, session_id)
+        return None, session, api_key, new_args
+
+    def _text_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def summarize(self, summary, messages) -> str:
+        """
+        fold old messages into the rolling summary of a session, used by the session compaction
+        :param summary: the current summary, empty for the first compaction
+        :param messages: the messages to fold in, oldest first
+        :return: the new summary, empty to keep the messages
+        """
+        if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            return ""
+        history = "\n".join("{}: {}".format(message["role"], message["content"]) for message in messages)
+        response = openai.ChatCompletion.create(
+            model=conf().get("session_compaction_model") or self.args["model"],
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "已有摘要:\n{}\n\n新的对话:\n{}".format(summary or "无", history)},
+            ],
+            temperature=0,
+            max_tokens=conf().get("session_compaction_summary_tokens", 300),
+            request_timeout=self.args["request_timeout"],
+        )
+        return response.choices[0]["message"]["content"].strip()
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -120,47 +172,76 @@ class ChatGPTBot(Bot, OpenAIImage):
             # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+            response = openai.ChatCompletion.create(api_key=api_key, messages=self.sessions.snapshot(session), **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            return self._completion_result(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+            result, delay = self._handle_error(e, session, retry_count)
+            if delay is None:
+                return result
+            time.sleep(delay)
+            return self.reply_text(session, api_key, args, retry_count + 1)
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
+    async def async_reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        reply_text on the async core: ChatCompletion.acreate over the shared aiohttp session, retries wait with asyncio.sleep
+        """
+        try:
+            if conf().get("rate_limit_chatgpt") and not await run_sync(self.tb4chatgpt.get_token):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            openai.aiosession.set(AsyncCore().http_session())
+            response = await openai.ChatCompletion.acreate(api_key=api_key, messages=self.sessions.snapshot(session), **args)
+            return self._completion_result(response)
+        except Exception as e:
+            # 出错时可能清除会话, 会读写session_store, 放到线程池里执行
+            result, delay = await run_sync(self._handle_error, e, session, retry_count)
+            if delay is None:
                 return result
+            await asyncio.sleep(delay)
+            return await self.async_reply_text(session, api_key, args, retry_count + 1)
+
+    def _completion_result(self, response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_error(self, e, session: ChatGPTSession, retry_count):
+        """
+        :return: (result to return when giving up, seconds to wait before the next retry or None to give up)
+        """
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        delay = 0
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            delay = 5
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+
+        if need_retry:
+            logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+            return result, delay
+        return result, None
 
 
 class AzureChatGPTBot(ChatGPTBot):
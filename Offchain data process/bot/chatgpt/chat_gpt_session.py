@@ -1,6 +1,8 @@
+import functools
+
 from bot.session_manager import Session
 from common.log import logger
-from common import const
+from common import const, token_counter
 
 """
     e.g.  [
@@ -12,12 +14,84 @@ from common import const
 """
 
 
+SUMMARY_HEADER = "\n\n以下是之前对话的摘要:\n"
+
+
 class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
         self.reset()
 
+    # message_tokens与messages一一对应, 每条消息只在第一次计算token时编码一次, 新消息总是在末尾, 未计算的(None)也总在末尾
+    def reset(self):
+        self.summary = ""  # 压缩进系统消息的旧对话摘要
+        super().reset()
+        self.message_tokens = [None]
+        self.counted_tokens = 0  # 已计算的消息的token之和
+        self.uncounted = 1  # 末尾还没计算token的消息数
+
+    def add_query(self, query):
+        super().add_query(query)
+        self.message_tokens.append(None)
+        self.uncounted += 1
+
+    def add_reply(self, reply):
+        super().add_reply(reply)
+        self.message_tokens.append(None)
+        self.uncounted += 1
+
+    def pop_message(self, index):
+        message = self.messages.pop(index)
+        if len(self.message_tokens) > len(self.messages):
+            tokens = self.message_tokens.pop(index)
+            if tokens is None:
+                self.uncounted -= 1
+            else:
+                self.counted_tokens -= tokens
+        return message
+
+    # 最近keep条以外的对话消息可以折叠进摘要
+    def compaction_candidates(self, keep):
+        return self.messages[1 : max(1, len(self.messages) - keep)]
+
+    def compact(self, summary, folded) -> bool:
+        if not folded or self.messages[1 : 1 + len(folded)] != folded:  # 生成摘要期间消息被裁剪或会话被重置
+            return False
+        for _ in folded:
+            self.pop_message(1)
+        self.summary = summary
+        self._set_system_message(self.system_prompt + SUMMARY_HEADER + summary)
+        return True
+
+    def _set_system_message(self, content):
+        self.messages[0] = {"role": "system", "content": content}
+        if len(self.message_tokens) != len(self.messages) or self.message_tokens[0] is None:
+            return  # 还没计算过, calc_tokens时一起计算
+        self.counted_tokens -= self.message_tokens[0]
+        try:
+            tokens = num_tokens_from_message(self.messages[0], self.model)
+        except Exception:
+            self.message_tokens = []  # 下次calc_tokens全部重新计算
+            return
+        self.message_tokens[0] = tokens
+        self.counted_tokens += tokens
+
+    def to_record(self) -> dict:
+        record = super().to_record()
+        record["k"] = self.message_tokens
+        record["s"] = self.summary
+        return record
+
+    def load_record(self, record: dict):
+        super().load_record(record)
+        self.summary = record.get("s", "")
+        self.message_tokens = record.get("k") or []
+        if len(self.message_tokens) != len(self.messages):  # 旧的或不一致的缓存, 全部重新计算
+            self.message_tokens = [None] * len(self.messages)
+        self.counted_tokens = sum(t for t in self.message_tokens if t is not None)
+        self.uncounted = self.message_tokens.count(None)
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -29,9 +103,9 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self.pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self.pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -50,47 +124,66 @@ class ChatGPTSession(Session):
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        if len(self.message_tokens) != len(self.messages):  # messages被外部直接修改过, 全部重新计算
+            self.message_tokens = [None] * len(self.messages)
+            self.counted_tokens = 0
+            self.uncounted = len(self.messages)
+        for i in range(len(self.messages) - self.uncounted, len(self.messages)):
+            tokens = num_tokens_from_message(self.messages[i], self.model)
+            self.message_tokens[i] = tokens
+            self.counted_tokens += tokens
+            self.uncounted -= 1
+        return self.counted_tokens + reply_priming_tokens(self.model)
 
 
-# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-def num_tokens_from_messages(messages, model):
-    """Returns the number of tokens used by a list of messages."""
-
+@functools.lru_cache(maxsize=None)
+def _token_model(model):
+    """the model whose counting rules apply, None for models counted by characters"""
     if model in ["wenxin", "xunfei", const.GEMINI]:
-        return num_tokens_by_character(messages)
+        return None
+    if model in ["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106"]:
+        return "gpt-3.5-turbo"
+    elif model in ["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW]:
+        return "gpt-4"
+    logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
 
-    import tiktoken
 
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106"]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
+def _message_overhead(message, token_model):
+    if token_model == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
+    else:
         tokens_per_message = 3
         tokens_per_name = 1
-    else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return tokens_per_message + (tokens_per_name if "name" in message else 0)
+
+
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by one message, without the tokens priming the reply."""
+    token_model = _token_model(model)
+    if token_model is None:
+        return len(message["content"])
+    return _message_overhead(message, token_model) + sum(token_counter.count_many(list(message.values()), token_model))
+
+
+def reply_priming_tokens(model):
+    if _token_model(model) is None:
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def num_tokens_from_messages(messages, model):
+    """Returns the number of tokens used by a list of messages."""
+    token_model = _token_model(model)
+    if token_model is None:
+        return num_tokens_by_character(messages)
+    # all values are encoded in one batch
+    values = [value for message in messages for value in message.values()]
+    overhead = sum(_message_overhead(message, token_model) for message in messages)
+    return overhead + sum(token_counter.count_many(values, token_model)) + reply_priming_tokens(model)
 
 
 def num_tokens_by_character(messages):
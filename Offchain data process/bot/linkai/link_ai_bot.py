@@ -398,20 +398,27 @@ class LinkAISessionManager(SessionManager):
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
-        session = self.build_session(session_id)
-        if query:
-            session.add_query(query)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 2500)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
-        return session
+        def change(session):
+            if query:
+                session.add_query(query)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 2500)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+
+        return self._update(session_id, change)
 
 
 class LinkAISession(ChatGPTSession):
+    # 按字符数估算token, 不使用逐条消息的token缓存, 也就不必保存它
+    def to_record(self) -> dict:
+        record = super().to_record()
+        del record["k"]
+        return record
+
     def calc_tokens(self):
         if not self.messages:
             return 0
@@ -422,7 +429,7 @@ class LinkAISession(ChatGPTSession):
         if cur_tokens > max_tokens:
             for i in range(0, len(self.messages)):
                 if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
+                    self.pop_message(i)
+                    self.pop_message(i - 1)
                     return self.calc_tokens()
         return cur_tokens
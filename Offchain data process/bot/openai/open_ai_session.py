@@ -1,4 +1,5 @@
 from bot.session_manager import Session
+from common import token_counter
 from common.log import logger
 
 
@@ -66,8 +67,4 @@ class OpenAISession(Session):
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string, disallowed_special=()))
-    return num_tokens
+    return token_counter.count(string, model)
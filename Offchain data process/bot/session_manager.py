@@ -1,7 +1,16 @@
-from common.expired_dict import ExpiredDict
+import threading
+import time
+
+from bot.session_store import create_store
+from common import metrics
+from common.elastic_pool import ElasticThreadPool
 from common.log import logger
 from config import conf
 
+_compaction_pool = None
+
+metrics.describe("session_prompt_tokens", "histogram", "tokens of the conversation history sent with a query", buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
@@ -29,6 +38,22 @@ class Session(object):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
 
+    # session_store为sqlite或redis时, 会话以record的形式保存
+    def to_record(self) -> dict:
+        return {"p": self.system_prompt, "m": self.messages}
+
+    def load_record(self, record: dict):
+        self.system_prompt = record["p"]
+        self.messages = record["m"]
+
+    # 会话压缩: 可以折叠进摘要的旧消息, 不支持压缩的会话返回空列表
+    def compaction_candidates(self, keep):
+        return []
+
+    # 用摘要替换折叠的旧消息, 返回是否有改动
+    def compact(self, summary, folded) -> bool:
+        return False
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
@@ -38,13 +63,13 @@ class Session(object):
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        # 不同的bot可能共用一个session_store, 按session类和模型区分各自的会话
+        self.store = create_store(":".join(str(part) for part in [sessioncls.__name__, session_args.get("model")] if part))
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.update_lock = threading.RLock()  # 内存中的session对象会被后台压缩修改
+        self.summarizer = None  # summarizer(summary, messages) -> 新的摘要, 由bot提供, 没有时不压缩会话
+        self.compacting = set()  # 正在后台压缩的session_id
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,38 +79,132 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+        if system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+            return self._update(session_id, lambda session: session.set_system_prompt(system_prompt))
+        return self._load(session_id)
+
+    def _load(self, session_id):
+        value, version = self.store.load(session_id)
+        if not self.store.shared:  # 内存里存的就是session对象
+            if value is None:
+                value = self.sessioncls(session_id, None, **self.session_args)
+                self.store.save(session_id, value, version)
+            return value
+        session = self.sessioncls(session_id, None, **self.session_args)
+        if value is not None:
+            session.load_record(value)
+        session.version = version
         return session
 
-    def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+    # 乐观并发: 读出session, 修改后按读出时的版本保存, 被其他进程抢先更新时重新读取再修改
+    def _update(self, session_id, change):
+        if session_id is None:
+            session = self.build_session(session_id)
+            change(session)
+            return session
+        if not self.store.shared:
+            with self.update_lock:
+                session = self._load(session_id)
+                change(session)
+                return session
+        retries = conf().get("session_store_retries", 5)
+        for _ in range(retries):
+            session = self._load(session_id)
+            if change(session) is False:  # 没有改动, 不用保存
+                return session
+            if self.store.save(session_id, session.to_record(), session.version):
+                return session
+            logger.debug("[SessionStore] session {} was updated concurrently, retry".format(session_id))
+            metrics.inc("session_store_conflicts_total")
+        logger.warning("[SessionStore] session {} not saved after {} conflicts".format(session_id, retries))
         return session
 
+    # 发给模型的消息副本: 内存中的session对象可能正被后台压缩修改
+    def snapshot(self, session):
+        with self.update_lock:
+            return list(session.messages)
+
+    def session_query(self, query, session_id):
+        def change(session):
+            session.add_query(query)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+                metrics.observe("session_prompt_tokens", total_tokens)
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+
+        return self._update(session_id, change)
+
     def session_reply(self, reply, session_id, total_tokens=None):
-        session = self.build_session(session_id)
-        session.add_reply(reply)
+        def change(session):
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+
+        session = self._update(session_id, change)
+        self._maybe_compact(session)
+        return session
+
+    # 会话超过conversation_max_tokens的session_compaction_ratio时, 在后台把旧消息折叠成摘要, 每个session同时只有一个压缩任务
+    def _maybe_compact(self, session):
+        if self.summarizer is None or session.session_id is None or not conf().get("session_compaction_enabled", False):
+            return
         try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            with self.update_lock:
+                tokens = session.calc_tokens()
         except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
-        return session
+            logger.debug("[Session] cannot count the tokens of session {}, not compacting: {}".format(session.session_id, e))
+            return
+        if tokens < conf().get("conversation_max_tokens", 1000) * conf().get("session_compaction_ratio", 0.5):
+            return
+        with self.update_lock:
+            if session.session_id in self.compacting:
+                return
+            self.compacting.add(session.session_id)
+        global _compaction_pool
+        if _compaction_pool is None:
+            _compaction_pool = ElasticThreadPool(min_workers=0, max_workers=conf().get("session_compaction_workers", 2), name="compaction")
+        _compaction_pool.submit(self._compact, session.session_id)
+
+    def _compact(self, session_id):
+        try:
+            session = self.build_session(session_id)
+            with self.update_lock:
+                folded = session.compaction_candidates(conf().get("session_compaction_keep_messages", 4))
+                previous = getattr(session, "summary", "")
+            if not folded:
+                return
+            start = time.monotonic()
+            summary = self.summarizer(previous, folded)
+            if not summary:
+                return
+            result = {}
+
+            def change(session):
+                result["compacted"] = session.compact(summary, folded)
+                return result["compacted"]
+
+            self._update(session_id, change)
+            if result.get("compacted"):
+                metrics.inc("session_compactions_total", result="compacted")
+                logger.info("[Session] folded {} messages of session {} into the summary in {:.1f}s".format(len(folded), session_id, time.monotonic() - start))
+            else:  # 生成摘要期间这些消息已被裁剪或会话被重置
+                metrics.inc("session_compactions_total", result="stale")
+        except Exception as e:
+            metrics.inc("session_compactions_total", result="error")
+            logger.warning("[Session] compaction of session {} failed: {}".format(session_id, e))
+        finally:
+            with self.update_lock:
+                self.compacting.discard(session_id)
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        self.store.delete(session_id)
 
     def clear_all_session(self):
-        self.sessions.clear()
+        self.store.clear()
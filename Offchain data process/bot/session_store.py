@@ -0,0 +1,212 @@
+"""
+Where SessionManager keeps conversation sessions (session_store).
+
+memory  sessions live in this process, as before (ExpiredDict when expires_in_seconds is set)
+sqlite  a local file, survives restarts and can be shared by processes on one host
+redis   any server speaking the redis protocol, shared by replicas behind a load balancer
+
+The sqlite and redis stores hold compact records (see encode_record) together
+with a version number. save() only succeeds when the stored version is still
+the one that was loaded, SessionManager reloads and applies its change again
+when another worker got there first.
+
+Bots share a store, so the sessions of every SessionManager live under their
+own namespace (the session class and model): a ChatGPT session and a Wenxin
+session of the same user are different records.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+COMPRESS_ABOVE = 512  # records larger than this many bytes are zlib compressed
+
+
+def encode_record(record: dict) -> bytes:
+    data = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) > COMPRESS_ABOVE:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def decode_record(data: bytes) -> dict:
+    data = bytes(data)
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]).decode("utf-8"))
+    return json.loads(data[1:].decode("utf-8"))
+
+
+class SessionStore(object):
+    shared = True  # records are kept outside the process, SessionManager serializes sessions
+
+    def __init__(self, namespace=""):
+        self.namespace = namespace
+
+    def key(self, session_id) -> str:
+        return "{}:{}".format(self.namespace, session_id) if self.namespace else str(session_id)
+
+    def load(self, session_id):
+        """:return: (record, version), (None, 0) if there is no session"""
+        raise NotImplementedError
+
+    def save(self, session_id, record, version) -> bool:
+        """store record as version + 1 if the stored version is still version (0 for a new session)"""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """the session objects themselves, only this process sees them so there is nothing to version"""
+
+    shared = False
+
+    def __init__(self, ttl=None, namespace=""):
+        super().__init__(namespace)  # every SessionManager has its own dict, the namespace is not needed here
+        self.sessions = ExpiredDict(ttl) if ttl else dict()
+
+    def load(self, session_id):
+        return self.sessions.get(session_id), 0
+
+    def save(self, session_id, session, version) -> bool:
+        self.sessions[session_id] = session
+        return True
+
+    def delete(self, session_id):
+        if session_id in self.sessions:
+            del self.sessions[session_id]
+
+    def clear(self):
+        self.sessions.clear()
+
+
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path, ttl=None, namespace=""):
+        super().__init__(namespace)
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, updated_at REAL NOT NULL)")
+            if ttl:
+                self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - ttl,))
+            self.conn.commit()
+        logger.info("[SessionStore] sqlite sessions in {}".format(path))
+
+    def load(self, session_id):
+        with self.lock:
+            row = self.conn.execute("SELECT version, data, updated_at FROM sessions WHERE id = ?", (self.key(session_id),)).fetchone()
+        if row is None:
+            return None, 0
+        version, data, updated_at = row
+        if self.ttl and updated_at < time.time() - self.ttl:
+            return None, version  # expired, a new session overwrites it under the same version check
+        return decode_record(data), version
+
+    def save(self, session_id, record, version) -> bool:
+        data = encode_record(record)
+        with self.lock:
+            if version == 0:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO sessions (id, version, data, updated_at) VALUES (?, 1, ?, ?)", (self.key(session_id), data, time.time()))
+            else:
+                cursor = self.conn.execute(
+                    "UPDATE sessions SET version = version + 1, data = ?, updated_at = ? WHERE id = ? AND version = ?", (data, time.time(), self.key(session_id), version)
+                )
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def delete(self, session_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE id = ?", (self.key(session_id),))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            if self.namespace:
+                prefix = self.key("")
+                self.conn.execute("DELETE FROM sessions WHERE substr(id, 1, ?) = ?", (len(prefix), prefix))
+            else:
+                self.conn.execute("DELETE FROM sessions")
+            self.conn.commit()
+
+
+class RedisSessionStore(SessionStore):
+    """one hash per session with the fields v (version) and d (record), the compare and set runs as a lua script"""
+
+    SAVE_SCRIPT = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'v') or '0')
+if version ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'v', version + 1, 'd', ARGV[2])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+    def __init__(self, url, prefix="session:", ttl=None, namespace="", client=None):
+        """:param client: a redis client to use instead of connecting to url"""
+        super().__init__(namespace)
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.save_script = self.client.register_script(self.SAVE_SCRIPT)
+        logger.info("[SessionStore] redis sessions at {} with prefix {}".format(url, self.key("")))
+
+    def key(self, session_id) -> str:
+        return self.prefix + super().key(session_id)
+
+    def load(self, session_id):
+        version, data = self.client.hmget(self.key(session_id), "v", "d")
+        if data is None:
+            return None, int(version or 0)
+        return decode_record(data), int(version)
+
+    def save(self, session_id, record, version) -> bool:
+        return self.save_script(keys=[self.key(session_id)], args=[version, encode_record(record), int(self.ttl or 0)]) == 1
+
+    def delete(self, session_id):
+        self.client.delete(self.key(session_id))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=re.sub(r"([\\*?\[\]])", r"\\\1", self.key("")) + "*", count=500))
+        for i in range(0, len(keys), 500):
+            self.client.delete(*keys[i : i + 500])
+
+
+def create_store(namespace="") -> SessionStore:
+    """:param namespace: keeps the sessions of one kind of bot apart from the others in a shared store"""
+    kind = conf().get("session_store", "memory")
+    ttl = conf().get("expires_in_seconds")
+    if kind == "sqlite":
+        path = conf().get("session_store_path")
+        if not path:
+            import os
+
+            from config import get_appdata_dir
+
+            path = os.path.join(get_appdata_dir(), "sessions.db")
+        return SqliteSessionStore(path, ttl=ttl, namespace=namespace)
+    if kind == "redis":
+        return RedisSessionStore(
+            conf().get("session_store_redis_url", "redis://localhost:6379/0"), prefix=conf().get("session_store_prefix", "session:"), ttl=ttl, namespace=namespace
+        )
+    return MemorySessionStore(ttl=ttl, namespace=namespace)
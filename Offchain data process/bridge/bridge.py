@@ -63,6 +63,9 @@ class Bridge(object):
     def fetch_reply_content(self, query, context: Context) -> Reply:
         return self.get_bot("chat").reply(query, context)
 
+    async def async_fetch_reply_content(self, query, context: Context) -> Reply:
+        return await self.get_bot("chat").async_reply(query, context)
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
@@ -5,6 +5,7 @@ Message sending channel abstract class
 from bridge.bridge import Bridge
 from bridge.context import Context
 from bridge.reply import *
+from common.async_core import run_sync
 
 
 class Channel(object):
@@ -34,9 +35,18 @@ class Channel(object):
         """
         raise NotImplementedError
 
+    async def async_send(self, reply: Reply, context: Context):
+        """
+        coroutine version of send used by the async core, by default the synchronous send runs on the async core executor
+        """
+        return await run_sync(self.send, reply, context)
+
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def async_build_reply_content(self, query, context: Context = None) -> Reply:
+        return await Bridge().async_fetch_reply_content(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
@@ -1,15 +1,20 @@
+import asyncio
 import os
 import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from common import async_core
+from common.async_core import AsyncCore, run_sync
 from common.dequeue import Dequeue
-from common import memory
+from common.elastic_pool import ElasticThreadPool
+from common.fair_scheduler import ADMIN, BULK, DM, GROUP, MENTION, FairScheduler
+from common import memory, metrics
 from plugins import *
 
 try:
@@ -24,10 +29,25 @@ class ChatChannel(Channel):
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
-    handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+    lock = threading.RLock()  # 用于控制对sessions的访问, 可重入是因为取消future时回调会在持有锁的线程里执行
+    ready = threading.Condition(lock)  # 有session可以调度时唤醒consume线程
+    scheduler = FairScheduler()  # 有待处理消息且并发未满的session_id, 按优先级分类加权轮转调度
+    class_queued = {}  # 每个优先级排队中的消息数, 用于限流
+    handler_pool = None  # 处理消息的线程池, 随排队的消息增减线程, 第一个channel初始化时按配置创建
 
     def __init__(self):
+        with self.lock:
+            if ChatChannel.handler_pool is None:
+                ChatChannel.handler_pool = ElasticThreadPool(
+                    min_workers=conf().get("handler_pool_min_workers", 8),
+                    max_workers=conf().get("handler_pool_max_workers", 64),
+                    idle_timeout=conf().get("handler_pool_idle_timeout", 60),
+                    target_wait=conf().get("handler_pool_target_wait", 0.5),
+                    name="handler",
+                )
+                ChatChannel.scheduler.configure(conf().get("chat_priority_weights", {}))
+                metrics.gauge("chat_ready_sessions", lambda: {(("class", k),): v for k, v in self.scheduler.stats().items()}, "sessions waiting for a handler by priority class")
+                metrics.gauge("chat_queued_messages", lambda: {(("class", k),): v for k, v in self.class_queued.items()}, "messages queued in sessions by priority class")
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -162,16 +182,80 @@ class ChatChannel(Channel):
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
-        logger.debug("[WX] ready to handle context: {}".format(context))
-        # reply的构建步骤
-        reply = self._generate_reply(context)
-
-        logger.debug("[WX] ready to decorate reply: {}".format(reply))
-        # reply的包装步骤
-        reply = self._decorate_reply(context, reply)
+        channel = self.channel_type or type(self).__name__
+        start = time.monotonic()
+        result = "error"
+        try:
+            logger.debug("[WX] ready to handle context: {}".format(context))
+            # reply的构建步骤
+            reply = self._generate_reply(context)
+
+            logger.debug("[WX] ready to decorate reply: {}".format(reply))
+            # reply的包装步骤
+            reply = self._decorate_reply(context, reply)
+
+            # reply的发送步骤
+            self._send_reply(context, reply)
+            result = "replied" if reply and reply.type else "no_reply"
+        finally:
+            metrics.observe("chat_handle_seconds", time.monotonic() - start, channel=channel, type=context.type)
+            metrics.inc("chat_handled_total", channel=channel, result=result)
+
+    # 异步核心下的_handle, 文本消息全程在事件循环上处理, 其他类型仍走同步流程
+    async def _async_handle(self, context: Context):
+        if context is None or not context.content:
+            return
+        if context.type not in [ContextType.TEXT, ContextType.IMAGE_CREATE]:
+            return await run_sync(self._handle, context)
+        channel = self.channel_type or type(self).__name__
+        start = time.monotonic()
+        result = "error"
+        try:
+            reply = await self._async_generate_reply(context)
+            reply = await run_sync(self._decorate_reply, context, reply)
+            await self._async_send_reply(context, reply)
+            result = "replied" if reply and reply.type else "no_reply"
+        finally:
+            metrics.observe("chat_handle_seconds", time.monotonic() - start, channel=channel, type=context.type)
+            metrics.inc("chat_handled_total", channel=channel, result=result)
+
+    async def _async_generate_reply(self, context: Context) -> Reply:
+        e_context = await PluginManager().async_emit_event(
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": Reply()},
+            )
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[WX] ready to handle context: type={}, content={}".format(context.type, context.content))
+            context["channel"] = e_context["channel"]
+            reply = await self.async_build_reply_content(context.content, context)
+        return reply
 
-        # reply的发送步骤
-        self._send_reply(context, reply)
+    async def _async_send_reply(self, context: Context, reply: Reply):
+        if reply and reply.type:
+            e_context = await PluginManager().async_emit_event(
+                EventContext(
+                    Event.ON_SEND_REPLY,
+                    {"channel": self, "context": context, "reply": reply},
+                )
+            )
+            reply = e_context["reply"]
+            if not e_context.is_pass() and reply and reply.type:
+                logger.debug("[WX] ready to send reply: {}, context: {}".format(reply, context))
+                for retry_cnt in range(3):
+                    try:
+                        await self.async_send(reply, context)
+                        return
+                    except NotImplementedError as e:
+                        logger.error("[WX] sendMsg error: {}".format(str(e)))
+                        return
+                    except Exception as e:
+                        logger.error("[WX] sendMsg error: {}".format(str(e)))
+                        logger.exception(e)
+                        if retry_cnt < 2:
+                            await asyncio.sleep(3 + 3 * retry_cnt)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
@@ -310,67 +394,230 @@ class ChatChannel(Channel):
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
-                self.sessions[session_id][1].release()
+                if session_id not in self.sessions:
+                    return
+                context_queue, semaphore = self.sessions[session_id]
+                semaphore.release()
+                self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                if not context_queue.empty():
+                    self._mark_ready(session_id)
+                elif semaphore._initial_value == semaphore._value:  # 没有排队也没有在处理的消息, 清理session
+                    del self.sessions[session_id]
+                    self.futures.pop(session_id, None)
 
         return func
 
+    # 调用方需持有self.lock
+    def _mark_ready(self, session_id):
+        if session_id in self.scheduler:
+            return
+        context_queue, semaphore = self.sessions[session_id]
+        if semaphore._value <= 0:  # 并发已满, 等有任务结束时再入队
+            return
+        # session按队首消息的优先级排队
+        if self.scheduler.push(session_id, context_queue.queue[0]["priority"]):
+            self.ready.notify()
+
+    # 消息的优先级分类: 管理命令 > 私聊 > 群聊@ > 群聊 > 批量导入, context里已有priority时以它为准
+    # 批量导入没法从消息本身看出来, alpha的各个通道在组装context时带上priority=BULK
+    def _priority_class(self, context: Context):
+        if "priority" in context:
+            return context["priority"]
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            return ADMIN
+        if not context.get("isgroup", False):
+            return DM
+        if getattr(context.get("msg"), "is_at", False):
+            return MENTION
+        return GROUP
+
+    # 调用方需持有self.lock, 超过该优先级的排队上限, 或总排队数过载时丢弃可丢弃的优先级
+    def _should_shed(self, priority):
+        limit = conf().get("chat_priority_queue_limits", {}).get(priority, 0)
+        if limit and self.class_queued.get(priority, 0) >= limit:
+            return "class_limit"
+        threshold = conf().get("chat_overload_threshold", 0)
+        if threshold and priority in conf().get("chat_overload_shed_classes", [BULK, GROUP]) and sum(self.class_queued.values()) >= threshold:
+            return "overload"
+        return None
+
+    def _dequeued(self, context: Context):
+        self.class_queued[context["priority"]] -= 1
+
+    # 调用方需持有self.lock, 返回队列已满的范围: session或global, 未满时返回None
+    def _queue_full(self, context_queue):
+        session_limit = conf().get("chat_session_queue_size", 0)
+        if session_limit and context_queue is not None and context_queue.qsize() >= session_limit:
+            return "session"
+        global_limit = conf().get("chat_global_queue_size", 0)
+        if global_limit and sum(self.class_queued.values()) >= global_limit:
+            return "global"
+        return None
+
+    # 调用方需持有self.lock, 队列满时按chat_queue_full_policy腾出位置, 返回结果: coalesced, dropped_oldest或rejected
+    def _make_room(self, session_id, context: Context, scope):
+        policy = conf().get("chat_queue_full_policy", "drop_oldest")
+        context_queue = self.sessions[session_id][0] if session_id in self.sessions else None
+        if policy == "coalesce" and context_queue is not None and self._coalesce(context_queue, context):
+            return "coalesced"
+        if policy == "reject":
+            return "rejected"
+        if scope == "global" and (context_queue is None or context_queue.empty()):
+            # 自己没有排队的消息时从积压最多的session里丢
+            context_queue = max((s[0] for s in self.sessions.values()), key=lambda q: q.qsize(), default=None)
+        if context_queue is None or self._drop_oldest(context_queue) is None:
+            return "rejected"
+        return "dropped_oldest"
+
+    # 同一个人连续发的文字消息合并到队尾那条里, 一次回复
+    def _coalesce(self, context_queue, context: Context):
+        with context_queue.mutex:
+            if not context_queue.queue:
+                return False
+            last = context_queue.queue[-1]
+            if context.type != ContextType.TEXT or last.type != ContextType.TEXT or last["priority"] != context["priority"]:
+                return False
+            if _sender(last) is None or _sender(last) != _sender(context):
+                return False
+            last.content = last.content + "\n" + context.content
+            return True
+
+    def _drop_oldest(self, context_queue):
+        with context_queue.mutex:
+            for context in context_queue.queue:
+                if context["priority"] != ADMIN:  # 管理命令不丢
+                    context_queue.queue.remove(context)
+                    self._dequeued(context)
+                    logger.info("[WX] queue full, dropped oldest message of session {}".format(context["session_id"]))
+                    return context
+        return None
+
+    def _reply_busy(self, context: Context):
+        text = conf().get("chat_queue_busy_reply", "")
+        if not text or self.handler_pool is None:
+            return
+
+        def send():
+            reply = self._decorate_reply(context, Reply(ReplyType.TEXT, text))
+            self._send_reply(context, reply)
+
+        self.handler_pool.submit(send)
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        priority = self._priority_class(context)
+        outcome = "queued"
         with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
-            else:
-                self.sessions[session_id][0].put(context)
+            reason = self._should_shed(priority)
+            if reason:
+                logger.warning("[WX] shed {} message of session {}, reason={}".format(priority, session_id, reason))
+                metrics.inc("chat_shed_total", **{"class": priority, "reason": reason})
+                return False
+            context["priority"] = priority
+            context["queued_at"] = time.monotonic()
+            scope = None
+            if priority != ADMIN:  # 管理命令不受队列长度限制
+                scope = self._queue_full(self.sessions[session_id][0] if session_id in self.sessions else None)
+            if scope:
+                outcome = self._make_room(session_id, context, scope)
+                metrics.inc("chat_queue_outcome_total", outcome=outcome, scope=scope)
+            if outcome not in ["coalesced", "rejected"]:
+                if session_id not in self.sessions:
+                    self.sessions[session_id] = [
+                        Dequeue(),
+                        threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                    ]
+                if priority == ADMIN:
+                    self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+                else:
+                    self.sessions[session_id][0].put(context)
+                self.class_queued[priority] = self.class_queued.get(priority, 0) + 1
+                self._mark_ready(session_id)
+        if outcome == "rejected":
+            logger.warning("[WX] queue full, rejected message of session {}".format(session_id))
+            self._reply_busy(context)
+            return False
+        if outcome != "coalesced":
+            metrics.inc("chat_queued_total", **{"class": priority})
+        return True
+
+    # 调用方需持有self.lock, 丢掉队首排队超过chat_queue_max_age秒的消息, 管理命令除外
+    def _expire(self, context_queue):
+        max_age = conf().get("chat_queue_max_age", 0)
+        if not max_age:
+            return
+        now = time.monotonic()
+        with context_queue.mutex:
+            while context_queue.queue:
+                context = context_queue.queue[0]
+                if context["priority"] == ADMIN or now - context["queued_at"] <= max_age:
+                    return
+                context_queue.queue.popleft()
+                self._dequeued(context)
+                logger.info("[WX] dropped message of session {} queued for {:.0f}s".format(context["session_id"], now - context["queued_at"]))
+                metrics.inc("chat_queue_outcome_total", outcome="expired", scope="session")
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，只在有消息入队或任务结束时被唤醒，每次只处理一个就绪的session
     def consume(self):
         while True:
             with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[WX] consume context: {}".format(context))
-                            future: Future = self.handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
+                while not self.scheduler:
+                    self.ready.wait()
+                session_id = self.scheduler.pop()
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                self._expire(context_queue)
+                if context_queue.empty() and semaphore._initial_value == semaphore._value:  # 消息全部过期, 清理session
+                    del self.sessions[session_id]
+                    self.futures.pop(session_id, None)
+                    continue
+                if context_queue.empty() or not semaphore.acquire(blocking=False):
+                    continue
+                context = context_queue.get()
+                self._dequeued(context)
+                logger.debug("[WX] consume context: {}".format(context))
+                if async_core.enabled():
+                    future: Future = AsyncCore().submit(self._async_handle(context))
+                else:
+                    future: Future = self.handler_pool.submit(self._handle, context)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+                if not context_queue.empty():
+                    self._mark_ready(session_id)  # 还有消息且并发未满时继续调度同一个session
+            # 回调放在锁外注册, 任务已结束时回调会在当前线程立即执行
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:  # 取消的回调可能已经清理了session
+                    return
                 cnt = self.sessions[session_id][0].qsize()
+                for context in list(self.sessions[session_id][0].queue):
+                    self._dequeued(context)
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
+                if self.sessions[session_id][1]._initial_value == self.sessions[session_id][1]._value:
+                    del self.sessions[session_id]
+                    self.futures.pop(session_id, None)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions.keys()):
+                self.cancel_session(session_id)
+
+
+def _sender(context: Context):
+    cmsg = context.get("msg")
+    if cmsg is None:
+        return None
+    return cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
 
 
 def check_prefix(content, prefix_list):
@@ -1,12 +1,18 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import discord
 from discord.ext import commands
+from alpha.pipeline import IngestionEngine, Message
 from config import conf
 import re
-import easyocr
 from channel.discords.discord_message import DiscordMessage
 from bridge.context import *
 from channel.chat_channel import ChatChannel, check_prefix
-import json
+from common import metrics
+from common.fair_scheduler import BULK
+from common.log import logger
+from common.throughput import ThroughputMeter
 
 # Summer Sheng
 # in this class, we only assume that the message would be sent by tweetshift robot
@@ -19,6 +25,21 @@ class DiscordChannel(commands.Bot, ChatChannel):
         super().__init__(command_prefix=command_prefix, intents=intents)
         self.bot_token = conf().get("discord_token")
         self.keyword = conf().get('keyword')
+        # on_message only parses and enqueues, the ingestion engine does the rest (see alpha.pipeline)
+        # so the gateway heartbeat never waits for ocr or the model
+        self.worker_count = max(1, conf().get("discord_ingest_workers", 4))
+        self.ingest_pool = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix="discord-ingest")
+        self.ingest_queue = None
+        self.throughput = ThroughputMeter()
+        self.dropped = 0  # messages dropped because the ingest queue was full
+
+    async def setup_hook(self):
+        self.ingest_queue = asyncio.Queue(maxsize=conf().get("discord_ingest_queue_size", 100))
+        for _ in range(self.worker_count):
+            asyncio.create_task(self._ingest_worker())
+        interval = conf().get("discord_throughput_log_interval", 60)
+        if interval:
+            asyncio.create_task(self._report_throughput(interval))
 
     async def on_ready(self):
         print(f'Logged in as {self.user.name} ({self.user.id})')
@@ -27,33 +48,61 @@ class DiscordChannel(commands.Bot, ChatChannel):
     async def on_message(self, message):
         text = message.content.split("[")[0]
         author_name = message.author.name[:message.author.name.find('• TweetShift' )]
-
         found, url = extract_image_url(message.content)
-        if found:
-            text += read_image_from_url(url)
-
+        # discord.py runs every event as its own task, waiting for room here would only pile up pending tasks,
+        # so a full queue drops the message and counts it
+        try:
+            self.ingest_queue.put_nowait((message, text, author_name, found, url))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.inc("alpha_messages_total", source="discord", event="shed")
+            logger.warning("[Discord] ingest queue is full ({} messages), dropped message {}".format(self.ingest_queue.qsize(), message.id))
+
+    async def _ingest_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message, text, author_name, found, url = await self.ingest_queue.get()
+            try:
+                # todo basing on the business requirement
+                # download certain messages depending on reply
+                item = Message(
+                    "discord",
+                    "Twitter",
+                    self.keyword,
+                    text=text,
+                    author=author_name,
+                    url=url,
+                    chat=message.channel.id,
+                    image_url=url if found else None,
+                    ask=lambda content, message=message: self._ask_relevant(message, content),
+                )
+                # IngestionEngine.submit blocks on the first stage's queue.Queue while the engine is full, running it
+                # on the event loop would stall the gateway heartbeat, so it runs in ingest_pool. Each worker waits for
+                # its own submit, so no more than discord_ingest_workers submits are in flight.
+                await loop.run_in_executor(self.ingest_pool, IngestionEngine().submit, item)
+            except Exception as e:
+                logger.exception("[Discord] failed to ingest message {}: {}".format(message.id, e))
+            finally:
+                self.throughput.mark()
+                self.ingest_queue.task_done()
+
+    async def _report_throughput(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(
+                "[Discord] ingest {:.2f} msg/s, total={}, queued={}, dropped={}".format(
+                    self.throughput.rate(), self.throughput.total, self.ingest_queue.qsize(), self.dropped
+                )
+            )
+
+    def _ask_relevant(self, message, text):
         prompt = "想象你是{}的专家，请问 \"{}\" 和 {} 相关吗？请只用是或否回答。".format(self.keyword, text, self.keyword)
-        context = self._compose_context(ContextType.TEXT, prompt, msg=DiscordMessage(message.id, prompt))
-        if context:
-            self.produce(context)
-        else:
+        context = self._compose_context(ContextType.TEXT, prompt, msg=DiscordMessage(message.id, prompt), priority=BULK)
+        if context is None:
             raise Exception("context is None")
+        # ask the bot directly, queueing the context as well would send the same prompt to the llm a second time
         reply = self.build_reply_content(query=prompt, context=context).content
-        # todo basing on the business requirement
-        # download certain messages depending on reply
-
-        if reply[0] == "是":
-            data = text
-            platform = "Twitter"
-            image_url = url
-
-            data_to_store = {
-                'url': image_url,
-                'data': data,
-                'platform': platform,
-                'author': author_name
-            }
-            write_to_json(data_to_store)
+        return reply[0] == "是"
 
     def startup(self):
         self.run(self.bot_token)
@@ -70,34 +119,3 @@ def extract_image_url(text):
     else:
         return False, None
 
-
-def read_image_from_url(url):
-    # directly send the url to the ocr reader
-    # if supports chinese and english
-    reader = easyocr.Reader(['ch_sim', 'en'], gpu=False, verbose=False)
-    result = reader.readtext(url, detail=0)
-    content = ""
-
-    for word in result:
-        content += word
-    return content
-
-
-def write_to_json(data):
-    json_file_path = "dataset.json"
-
-    # Open the file in append mode
-    with open(json_file_path, 'a', encoding='utf-8') as json_file:
-        # Move the cursor to the end of the file
-        json_file.seek(0, 2)
-
-        # If the file is not empty, add a comma before appending the new data
-        if json_file.tell() > 0:
-            json_file.write(',')
-
-        # Convert the dictionary to a JSON-formatted string and append it to the file
-        json.dump(data, json_file, ensure_ascii=False)
-        # Add a newline character for better readability
-        json_file.write('\n')
-
-    print(f"Data has been appended to {json_file_path}")
@@ -6,11 +6,9 @@
 """
 
 # -*- coding=utf-8 -*-
-import uuid
-
-import PIL.Image
 import requests
 import web
+from alpha.pipeline import IngestionEngine, Message
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
@@ -21,11 +19,10 @@ from common.expired_dict import ExpiredDict
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
 from common import utils
+from common.fair_scheduler import BULK
+from common.media import fetch_bytes
 import json
-import os
 import time
-import easyocr
-import PIL
 
 URL_VERIFICATION = "url_verification"
 
@@ -137,13 +134,10 @@ class FeiShuChanel(ChatChannel):
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        # keep the image in memory, no temp file in the working directory
+        image = fetch_bytes(img_url)
         suffix = utils.get_path_suffix(img_url)
-        temp_name = str(uuid.uuid4()) + "." + suffix
-        if response.status_code == 200:
-            # 将图片内容保存为临时文件
-            with open(temp_name, "wb") as file:
-                file.write(response.content)
+        file_name = "image." + (suffix or "png")
 
         # upload
         upload_url = "https://open.feishu.cn/open-apis/im/v1/images"
@@ -153,11 +147,9 @@ class FeiShuChanel(ChatChannel):
         headers = {
             'Authorization': f'Bearer {access_token}',
         }
-        with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
-            logger.info(f"[FeiShu] upload file, res={upload_response.content}")
-            os.remove(temp_name)
-            return upload_response.json().get("data").get("image_key")
+        upload_response = requests.post(upload_url, files={"image": (file_name, bytes(image))}, data=data, headers=headers)
+        logger.info(f"[FeiShu] upload file, res={upload_response.content}")
+        return upload_response.json().get("data").get("image_key")
 
 
 class FeishuController:
@@ -294,51 +286,53 @@ class FeishuController:
         if message_id is not None and self._is_new(request):
             access_token = channel.fetch_access_token()
             user_name = channel.fetch_username(user_id)
-            url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=chat_id"
+            item = Message(
+                "feishu",
+                "Feishu",
+                keyword,
+                author=user_name,
+                ask=lambda text: self._ask_relevant(channel, keyword, request, text),
+                on_accepted=lambda message: self._send_forward(message, access_token),
+                chat=request['event']['message'].get('chat_id'),
+            )
 
             # resend text message
-            if msg_type == 'text' and self._is_relevant(channel=channel, request=request, keyword='天气'):
-                message = content.split(":")[1][1:-2]
+            if msg_type == 'text':
+                # strip \"\"
+                item.text = content.split(":")[1][1:-2]
 
             # todo make forwarding images work
             elif msg_type == "image":
-
-                message = self._read_image(request, access_token)
-                if not self._is_relevant(channel=channel,keyword=keyword,request=request, img_message=message):
-                    return self.SUCCESS_MSG
+                image_key = content.split(":")[1][1:-2]
+                item.image_url = "https://open.feishu.cn/open-apis/im/v1/images/{}".format(image_key)
+                item.image_headers = {'Authorization': 'Bearer {}'.format(access_token)}
             else:
                 return self.SUCCESS_MSG
+            # ocr and the relevance check run in the ingestion engine, the webhook returns right away
+            IngestionEngine().submit(item)
+            return self.SUCCESS_MSG
 
-            forward_message = "{\"text\":" + "\"" + user_name + ": " + message + "\"" + "}"
+    def _send_forward(self, message, access_token):
+        url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=chat_id"
+        forward_message = "{\"text\":" + "\"" + message.author + ": " + message.text + "\"" + "}"
 
-            payload = json.dumps({
-                "content": forward_message,
-                "msg_type": "text",
-                "receive_id": conf().get("feishu_group_chat_destination"),
-            })
+        payload = json.dumps({
+            "content": forward_message,
+            "msg_type": "text",
+            "receive_id": conf().get("feishu_group_chat_destination"),
+        })
 
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer {}'.format(access_token)
-            }
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer {}'.format(access_token)
+        }
 
-            response = requests.request("POST", url, headers=headers, data=payload)
-            return response.text
+        response = requests.request("POST", url, headers=headers, data=payload, timeout=(5, 10))
+        return response.text
 
-    def _is_relevant(self, channel, keyword, request, img_message=None):
+    def _ask_relevant(self, channel, keyword, request, message):
         feishu_msg = FeishuMessage(request['event'], is_group=True, access_token=channel.fetch_access_token())
         receive_id_type = "chat_id"
-        content = request['event']['message']['content']
-        msg_type = request['event']['message']['message_type']
-
-        if msg_type == "image":
-            message = img_message
-        elif msg_type == "text":
-            # strip \"\"
-            message = content.split(":")[1][1:-2]
-        else:
-            message = None
-
         query = "你是{}的专家，请只用是或否回答， 这句句子\"{}\"， 是否和{}相关？".format(keyword, message, keyword)
         context = self._compose_context(
             ContextType.TEXT,
@@ -347,6 +341,7 @@ class FeishuController:
             no_need_at=False,
             msg=feishu_msg,
             receive_id_type=receive_id_type,
+            priority=BULK,
         )
         reply = channel.build_reply_content(query=query, context=context).content
 
@@ -356,31 +351,3 @@ class FeishuController:
         message_time = int(request['event']['message']['create_time'])
         now = int(round(1000 * time.time()))
         return now - message_time <= 10000
-
-
-    def _read_image(self, request, access_token):
-        image_key = (request['event']['message']['content']).split(":")[1][1:-2]
-        url = "https://open.feishu.cn/open-apis/im/v1/images/{}".format(image_key)
-        payload = ''
-
-        headers = {
-            'Authorization': 'Bearer {}'.format(access_token)
-        }
-
-        response = requests.request("GET", url, headers=headers, data=payload)
-        import io
-        temp_name = str(uuid.uuid4()) + "." + "jpeg"
-        if response.status_code == 200:
-            # 将图片内容保存为临时文件
-            with open(temp_name, "wb") as file:
-                file.write(response.content)
-        img = PIL.Image.open(temp_name)
-
-        # todo make it read from the command line
-        reader = easyocr.Reader(['ch_sim', 'en'], gpu=False)  # this needs to run only once to load the model into memory
-
-        result = reader.readtext(img, detail=0)
-        content = ""
-        for words in result:
-            content += words
-        return content
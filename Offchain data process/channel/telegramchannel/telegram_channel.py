@@ -1,5 +1,8 @@
+import asyncio
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+from alpha.pipeline import IngestionEngine, Message
 from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
@@ -7,9 +10,9 @@ from channel.chat_message import ChatMessage
 from config import conf
 from telegram import Update
 from telegram.ext import Application, MessageHandler, ContextTypes, filters
-from PIL import Image
-import easyocr
-import json
+from common.fair_scheduler import BULK
+from common.log import logger
+from common.throughput import ThroughputMeter
 
 
 class TelegramMessage(ChatMessage):
@@ -33,8 +36,13 @@ class TelegramMessage(ChatMessage):
 class TelegramChannel(ChatChannel):
     def __init__(self):
         self.bot_token = conf().get("telegram_token")
-        self.application = Application.builder().token(self.bot_token).build()
+        # python-telegram-bot runs up to this many update handlers at the same time, the rest wait
+        self.concurrent_updates = max(1, conf().get("telegram_concurrent_updates", 8))
+        self.application = Application.builder().token(self.bot_token).concurrent_updates(self.concurrent_updates).build()
         self.keyword = conf().get('keyword')
+        # handing a message to the ingestion engine may block, it happens here so polling keeps flowing
+        self.ingest_pool = ThreadPoolExecutor(max_workers=max(1, conf().get("telegram_ingest_workers", 4)), thread_name_prefix="telegram-ingest")
+        self.throughput = ThroughputMeter()
 
     async def downloader(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new_file = await update.message.effective_attachment[-1].get_file()
@@ -42,68 +50,52 @@ class TelegramChannel(ChatChannel):
         return file
 
     async def download_relevant_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        content = ""
-        if update.message.photo:
-            img_file = await update.message.effective_attachment[-1].get_file()
-            file = await img_file.download_to_drive()
-            image = Image.open(file)
-            caption = update.message.caption if update.message.caption is not None else ""
-            reader = easyocr.Reader(['ch_sim', 'en'], gpu=False, verbose=False)
-            result = reader.readtext(image, detail=0)
-
-            for word in result:
-                content += word
-            content += caption
-        elif update.message.text:
-            content = update.message.text
-        else:
-            pass
-
+        if update.message is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            content = ""
+            image = None
+            if update.message.photo:
+                img_file = await update.message.effective_attachment[-1].get_file()
+                # keep the image in memory, it is only needed for ocr
+                image = bytes(await img_file.download_as_bytearray())
+                content = update.message.caption if update.message.caption is not None else ""
+            elif update.message.text:
+                content = update.message.text
+            else:
+                return
+
+            item = Message(
+                "telegram",
+                "Telegram",
+                self.keyword,
+                text=content,
+                image=image,
+                ask=lambda text: self._ask_relevant(update, text),
+                chat=update.effective_chat.id if update.effective_chat else None,
+            )
+            # submit blocks while the engine is full, polling keeps flowing meanwhile
+            await loop.run_in_executor(self.ingest_pool, IngestionEngine().submit, item)
+        finally:
+            self.throughput.mark()
+
+    def _ask_relevant(self, update: Update, content):
         prompt = "想象你是{}的专家，请问 \"{}\" 和 {} 相关吗？请只用是或否回答。".format(self.keyword, content, self.keyword)
-        context = self._compose_context(ContextType.TEXT, prompt, msg=TelegramMessage(update.message.message_id, prompt))
-        if context:
-            self.produce(context)
-        else:
+        context = self._compose_context(ContextType.TEXT, prompt, msg=TelegramMessage(update.message.message_id, prompt), priority=BULK)
+        if context is None:
             raise Exception("context is None")
+        # ask the bot directly, queueing the context as well would send the same prompt to the llm a second time
         reply = self.build_reply_content(query=prompt, context=context).content
-        print(reply)
-
-        if reply[0] == "是":
-            data = content
-            platform = "Telegram"
-            image_url = None
-            author_name = None
+        logger.debug("[Telegram] relevance reply: {}".format(reply))
+        return reply[0] == "是"
 
-            data_to_store = {
-                'url': image_url,
-                'data': data,
-                'platform': platform,
-                'author': author_name
-            }
-            write_to_json(data_to_store)
+    async def _report_throughput(self, context: ContextTypes.DEFAULT_TYPE):
+        logger.info("[Telegram] ingest {:.2f} msg/s, total={}".format(self.throughput.rate(), self.throughput.total))
 
     def startup(self):
         self.application.add_handler(MessageHandler(filters.ALL, self.download_relevant_info))
+        interval = conf().get("telegram_throughput_log_interval", 60)
+        if interval and self.application.job_queue is not None:
+            self.application.job_queue.run_repeating(self._report_throughput, interval=interval)
         self.application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-def write_to_json(data):
-    json_file_path = "dataset.json"
-
-    # Open the file in append mode
-    with open(json_file_path, 'a', encoding='utf-8') as json_file:
-        # Move the cursor to the end of the file
-        json_file.seek(0, 2)
-
-        # If the file is not empty, add a comma before appending the new data
-        if json_file.tell() > 0:
-            json_file.write(',')
-
-        # Convert the dictionary to a JSON-formatted string and append it to the file
-        json.dump(data, json_file, ensure_ascii=False)
-        # Add a newline character for better readability
-        json_file.write('\n')
-
-    print(f"Data has been appended to {json_file_path}")
-
-
-
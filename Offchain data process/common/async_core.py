@@ -0,0 +1,66 @@
+"""
+Optional asyncio core of the reply flow (async_core_enabled).
+
+One event loop runs in a background thread and every in-flight message is a
+task on it instead of a thread of its own. Bots, channels and plugins may
+provide coroutine versions of their hooks (Bot.async_reply,
+Channel.async_send, async plugin handlers); anything that is still
+synchronous is adapted with run_sync(), which runs it on a bounded executor.
+
+HTTP calls made from the loop share one pooled aiohttp session, see
+http_session().
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+
+@singleton
+class AsyncCore(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # sync bots, plugins and channels run here, it bounds the threads no matter how many tasks are in flight
+        self.executor = ThreadPoolExecutor(max_workers=conf().get("async_core_executor_workers", 16), thread_name_prefix="async-sync")
+        self.loop.set_default_executor(self.executor)
+        self.session = None
+        self.started = threading.Event()
+        _thread = threading.Thread(target=self._run, name="async-core")
+        _thread.setDaemon(True)
+        _thread.start()
+        self.started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.started.set)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """schedule a coroutine on the core loop from any thread, cancelling the returned future cancels the task"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_sync(self, func, *args):
+        """await a synchronous call without blocking the loop"""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def http_session(self):
+        """the shared aiohttp session, only to be used from the core loop"""
+        if self.session is None or self.session.closed:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=conf().get("async_core_http_connections", 100))
+            self.session = aiohttp.ClientSession(connector=connector)
+            logger.info("[AsyncCore] created pooled http session")
+        return self.session
+
+
+async def run_sync(func, *args):
+    return await AsyncCore().run_sync(func, *args)
+
+
+def enabled() -> bool:
+    return conf().get("async_core_enabled", False)
@@ -0,0 +1,154 @@
+"""
+Thread pool that grows with its backlog and shrinks when idle.
+
+Handler work is mostly waiting on LLM HTTP calls, so the right number of
+threads depends on the load, not on the cores. A worker is added whenever a
+task is queued and no worker is idle (up to max_workers). Queue depth alone
+misses tasks that sit behind workers counted as idle but not yet picking
+up, so the pool also watches latency: a task that waited longer than
+target_wait adds a worker while more tasks are queued, and no worker retires
+while the recent average wait is above target_wait. Otherwise a worker that
+stays idle for idle_timeout seconds exits (down to min_workers).
+
+The pool measures how long tasks wait in the queue and how long they run,
+and reports utilization (busy / alive workers) through stats() and
+common.metrics.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+from common import metrics
+from common.log import logger
+
+
+class ElasticThreadPool(object):
+    def __init__(self, min_workers=4, max_workers=64, idle_timeout=60, name="pool", initializer=None, target_wait=0.5):
+        """
+        :param initializer: callable run at the start of every worker thread, same as ThreadPoolExecutor
+        :param target_wait: seconds a task may wait for a thread before the pool grows and stops shrinking, 0 disables
+        """
+        self.min_workers = max(0, min_workers)
+        self.max_workers = max(1, max_workers, self.min_workers)
+        self.idle_timeout = idle_timeout
+        self.target_wait = target_wait
+        self.name = name
+        self._initializer = initializer
+        self.tasks = Queue()
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.workers = 0
+        self.idle = 0
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.wait_seconds = 0.0
+        self.recent_wait = 0.0  # moving average of the queue wait, seconds
+        self.run_seconds = 0.0
+        self.peak_workers = 0
+        self.is_shutdown = False
+        metrics.gauge("{}_pool_workers".format(name), lambda: {(("state", "busy"),): self.busy, (("state", "idle"),): self.idle}, "threads of the {} pool".format(name))
+        metrics.gauge("{}_pool_queued".format(name), lambda: self.tasks.qsize(), "tasks waiting for a thread of the {} pool".format(name))
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if self.is_shutdown:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        future = Future()
+        self.tasks.put((future, fn, args, kwargs, time.monotonic()))
+        with self.lock:
+            self.submitted += 1
+            # every queued task that no idle worker will pick up gets a new thread
+            if self.tasks.qsize() > self.idle and self.workers < self.max_workers:
+                self._spawn()
+        return future
+
+    def _spawn(self):
+        # caller holds self.lock
+        self.workers += 1
+        self.idle += 1
+        self.peak_workers = max(self.peak_workers, self.workers)
+        _thread = threading.Thread(target=self._work, name="{}-{}".format(self.name, self.submitted), daemon=True)
+        self.threads.add(_thread)
+        _thread.start()
+
+    def _work(self):
+        if self._initializer is not None:
+            try:
+                self._initializer()
+            except Exception as e:
+                logger.exception("[{}] worker initializer failed: {}".format(self.name, e))
+        while True:
+            try:
+                item = self.tasks.get(timeout=self.idle_timeout)
+            except Empty:
+                with self.lock:
+                    # tasks have been waiting lately, keep the thread for the next burst
+                    if self.workers > self.min_workers and not (self.target_wait and self.recent_wait > self.target_wait):
+                        self._retire()
+                        return
+                    self.recent_wait /= 2  # an idle period counts as a wait of 0
+                continue
+            if item is None:  # shutdown
+                with self.lock:
+                    self._retire()
+                return
+            future, fn, args, kwargs, queued_at = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            waited = start - queued_at
+            with self.lock:
+                self.idle -= 1
+                self.busy += 1
+                self.wait_seconds += waited
+                self.recent_wait = 0.8 * self.recent_wait + 0.2 * waited
+                if self.target_wait and waited > self.target_wait and self.tasks.qsize() > 0 and self.workers < self.max_workers and not self.is_shutdown:
+                    self._spawn()
+            metrics.observe("{}_pool_wait_seconds".format(self.name), start - queued_at)
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                elapsed = time.monotonic() - start
+                with self.lock:
+                    self.busy -= 1
+                    self.idle += 1
+                    self.completed += 1
+                    self.run_seconds += elapsed
+                metrics.observe("{}_pool_run_seconds".format(self.name), elapsed)
+
+    def _retire(self):
+        # caller holds self.lock
+        self.workers -= 1
+        self.idle -= 1
+        self.threads.discard(threading.current_thread())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "idle": self.idle,
+                "peak_workers": self.peak_workers,
+                "queued": self.tasks.qsize(),
+                "utilization": round(self.busy / self.workers, 2) if self.workers else 0.0,
+                "avg_wait_ms": round(self.wait_seconds * 1000 / self.completed, 1) if self.completed else 0.0,
+                "recent_wait_ms": round(self.recent_wait * 1000, 1),
+                "avg_run_ms": round(self.run_seconds * 1000 / self.completed, 1) if self.completed else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        """stop the workers once the queued tasks are done, :param wait: block until every worker has exited"""
+        with self.lock:
+            self.is_shutdown = True
+            workers = self.workers
+            threads = list(self.threads)
+        for _ in range(workers):
+            self.tasks.put(None)
+        if wait:
+            for _thread in threads:
+                if _thread is not threading.current_thread():
+                    _thread.join()
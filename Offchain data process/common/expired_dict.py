@@ -1,28 +1,96 @@
-from datetime import datetime, timedelta
+"""
+Dict whose entries expire expires_in_seconds after they were last written or read.
 
+Entries are kept in an OrderedDict in the order they were last touched, and
+every touch moves the entry to the end with a new deadline. Since all
+entries share the same ttl, the front is always the entry that expires next:
+expired entries are popped from the front on every write (and by a
+background sweeper for caches nobody writes to), which is amortized O(1).
+With max_size the front is also the least recently used entry, which is
+evicted when the dict grows beyond it.
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+Deadlines use time.monotonic(), so clock changes do not expire or revive
+entries. All operations are thread-safe.
+"""
+
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+SWEEP_INTERVAL = 60  # seconds between background sweeps
+
+_caches = []  # weak references, a mapping is not hashable so no WeakSet
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        with _sweeper_lock:
+            _caches[:] = [ref for ref in _caches if ref() is not None]
+            caches = [ref() for ref in _caches]
+        for cache in caches:
+            if cache is not None:
+                cache.expire()
+
+
+def _register(cache):
+    global _sweeper
+    with _sweeper_lock:
+        _caches.append(weakref.ref(cache))
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_forever, name="expired-dict-sweeper")
+            _sweeper.setDaemon(True)
+            _sweeper.start()
+
+
+class ExpiredDict(MutableMapping):
+    def __init__(self, expires_in_seconds, max_size=None):
+        """
+        :param max_size: evict the least recently used entries above this many, None for no bound
+        """
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (value, deadline), least recently touched first
+        self._lock = threading.RLock()
+        _register(self)
+
+    def expire(self):
+        """drop the expired entries, called on writes and periodically in the background"""
+        now = time.monotonic()
+        with self._lock:
+            while self._data:
+                key, (value, deadline) = next(iter(self._data.items()))
+                if deadline > now:
+                    break
+                del self._data[key]
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._lock:
+            value, deadline = self._data[key]
+            now = time.monotonic()
+            if now > deadline:
+                del self._data[key]
+                raise KeyError("expired {}".format(key))
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            self.expire()
+            if self.max_size:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
         try:
@@ -31,12 +99,29 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def __len__(self):
+        self.expire()
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        self.expire()
+        with self._lock:
+            return list(self._data.keys())
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        self.expire()
+        with self._lock:
+            return [(key, value) for key, (value, deadline) in self._data.items()]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __repr__(self):
+        return "ExpiredDict({})".format(dict(self.items()))
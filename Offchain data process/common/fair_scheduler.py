@@ -0,0 +1,77 @@
+"""
+Weighted fair scheduling of ready sessions across priority classes.
+
+Every ready session sits in the queue of its priority class. pop() picks the
+class with smooth weighted round robin (the nginx upstream algorithm), so
+with weights 8:4:4:2:1 a flood of group or bulk sessions still leaves most
+turns to admin commands and direct messages, but never starves anyone.
+Inside a class sessions take turns, a chatty session gets one dispatch per
+round like everybody else. Both steps are O(number of classes).
+
+The scheduler is not thread-safe, ChatChannel calls it under its lock.
+"""
+
+from collections import deque
+
+ADMIN = "admin"
+DM = "dm"
+MENTION = "mention"
+GROUP = "group"
+BULK = "bulk"  # ingestion prompts, the channels tag them with context["priority"]
+
+DEFAULT_WEIGHTS = {ADMIN: 8, DM: 4, MENTION: 4, GROUP: 2, BULK: 1}
+
+
+class FairScheduler(object):
+    def __init__(self, weights=None):
+        self.weights = {}
+        self.queues = {}
+        self.current = {}
+        self.members = {}  # session_id -> class, a session is queued at most once
+        self.configure(weights)
+
+    def configure(self, weights=None):
+        """set the weights, {class: weight} on top of DEFAULT_WEIGHTS, sessions already waiting keep their place"""
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        for name in self.weights:
+            self.queues.setdefault(name, deque())
+            self.current.setdefault(name, 0)
+
+    def push(self, session_id, priority_class) -> bool:
+        """:return: False if the session is already waiting for its turn"""
+        if session_id in self.members:
+            return False
+        if priority_class not in self.queues:
+            priority_class = GROUP
+        self.members[session_id] = priority_class
+        self.queues[priority_class].append(session_id)
+        return True
+
+    def pop(self):
+        """:return: the next session id to serve, None if no session is ready"""
+        total = 0
+        best = None
+        for name, queue in self.queues.items():
+            if not queue:
+                continue
+            weight = self.weights[name]
+            self.current[name] += weight
+            total += weight
+            if best is None or self.current[name] > self.current[best]:
+                best = name
+        if best is None:
+            return None
+        self.current[best] -= total
+        session_id = self.queues[best].popleft()
+        del self.members[session_id]
+        return session_id
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, session_id):
+        return session_id in self.members
+
+    def stats(self) -> dict:
+        return {name: len(queue) for name, queue in self.queues.items()}
@@ -0,0 +1,67 @@
+"""
+Shared media fetcher.
+
+Images are streamed into an in-memory buffer that is capped at
+media_max_bytes and must arrive within ocr_download_timeout seconds, then
+decoded once into an RGB numpy array that OCR consumes as is. Nothing is
+written to disk.
+"""
+
+import io
+import time
+
+import requests
+
+from common.log import logger
+from config import conf
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def fetch_bytes(url, headers=None, max_bytes=None, timeout=None) -> bytearray:
+    """
+    download into memory, aborting as soon as the body exceeds max_bytes or the whole download exceeds timeout
+    :param max_bytes: defaults to media_max_bytes
+    :param timeout: seconds for the whole download, defaults to ocr_download_timeout
+    """
+    max_bytes = max_bytes or conf().get("media_max_bytes", 20 * 1024 * 1024)
+    timeout = timeout or conf().get("ocr_download_timeout", 15)
+    deadline = time.monotonic() + timeout
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise MediaTooLarge("{} is {} bytes, limit is {}".format(url, length, max_bytes))
+        buffer = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                raise MediaTooLarge("{} is larger than {} bytes".format(url, max_bytes))
+            if time.monotonic() > deadline:
+                raise TimeoutError("downloading {} took longer than {}s".format(url, timeout))
+    logger.debug("[Media] fetched {} bytes from {}".format(len(buffer), url))
+    return buffer
+
+
+def decode_image(data):
+    """decode image bytes into an RGB numpy array (height, width, 3)"""
+    import numpy as np
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    # refuse decompression bombs before the pixels are allocated
+    max_pixels = conf().get("media_max_pixels", 50000000)
+    if max_pixels and image.size[0] * image.size[1] > max_pixels:
+        raise MediaTooLarge("image of {}x{} pixels is above the limit of {}".format(image.size[0], image.size[1], max_pixels))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+def fetch_image(url, headers=None):
+    """download and decode an image, see fetch_bytes for the limits"""
+    return decode_image(fetch_bytes(url, headers=headers))
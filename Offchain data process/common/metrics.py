@@ -0,0 +1,143 @@
+"""
+Process-wide counters, gauges and latency histograms.
+
+Instrumented code calls inc() / observe() with a metric name and labels,
+e.g. observe("alpha_stage_seconds", 0.12, stage="ocr", source="discord").
+render() returns everything in the Prometheus text format, which is served
+on http://0.0.0.0:{metrics_port}/metrics when metrics_port is set.
+"""
+
+import bisect
+import threading
+
+from common.log import logger
+from config import conf
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_help = {}  # name -> (type, help)
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., overflow, sum, count]
+_buckets = {}  # histogram name -> bucket upper bounds
+_gauges = {}  # name -> callable returning {labels: value}
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name, kind, text, buckets=None):
+    """
+    declare the type (counter, gauge or histogram) and help text of a metric, optional but shown on the endpoint
+    :param buckets: upper bounds in seconds for a histogram, DEFAULT_BUCKETS otherwise
+    """
+    with _lock:
+        _help[name] = (kind, text)
+        if buckets:
+            _buckets[name] = tuple(sorted(buckets))
+
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = (name, _labels(labels))
+    with _lock:
+        buckets = _buckets.get(name, DEFAULT_BUCKETS)
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(buckets) + 3)  # buckets, overflow, sum, count
+        values[bisect.bisect_left(buckets, seconds)] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+def gauge(name, func, text=""):
+    """
+    :param func: callable returning {labels dict as a tuple of (key, value): value}, or a plain number; evaluated on render
+    """
+    with _lock:
+        _help[name] = ("gauge", text)
+        _gauges[name] = func
+
+
+def _format_labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+def render() -> str:
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        gauges = dict(_gauges)
+        helps = dict(_help)
+        buckets = dict(_buckets)
+    lines = []
+    emitted = set()
+
+    def header(name, default_kind):
+        if name in emitted:
+            return
+        emitted.add(name)
+        kind, text = helps.get(name, (default_kind, ""))
+        if text:
+            lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append("{}{} {}".format(name, _format_labels(labels), value))
+    for (name, labels), values in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(buckets.get(name, DEFAULT_BUCKETS), values):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, _format_labels(labels, [("le", bound)]), cumulative))
+        lines.append("{}_bucket{} {}".format(name, _format_labels(labels, [("le", "+Inf")]), values[-1]))
+        lines.append("{}_sum{} {}".format(name, _format_labels(labels), round(values[-2], 6)))
+        lines.append("{}_count{} {}".format(name, _format_labels(labels), values[-1]))
+    for name, func in sorted(gauges.items()):
+        try:
+            result = func()
+        except Exception as e:
+            logger.warning("[Metrics] gauge {} failed: {}".format(name, e))
+            continue
+        header(name, "gauge")
+        if not isinstance(result, dict):
+            result = {(): result}
+        for labels, value in sorted(result.items()):
+            lines.append("{}{} {}".format(name, _format_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsController:
+    def GET(self):
+        import web
+
+        web.header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return render()
+
+
+def start_server(port=None):
+    """serve /metrics from a daemon thread, next to whatever web.py server the channel runs"""
+    port = port or conf().get("metrics_port", 0)
+    if not port:
+        return
+
+    def serve():
+        import web
+
+        app = web.application(("/metrics", "common.metrics.MetricsController"), globals(), autoreload=False)
+        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+
+    _thread = threading.Thread(target=serve, name="metrics-server")
+    _thread.setDaemon(True)
+    _thread.start()
+    logger.info("[Metrics] serving on http://0.0.0.0:{}/metrics".format(port))
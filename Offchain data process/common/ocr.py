@@ -0,0 +1,252 @@
+"""
+Process-wide OCR engine shared by every channel.
+
+The easyocr models are loaded once, lazily, on the first image. Recognition
+requests go through a bounded queue and are served by a fixed number of
+worker threads, so several images can be recognized at the same time while
+the models stay resident in memory.
+
+During bursts a worker keeps collecting queued images for a short window (or
+until the batch is full), pads them to a common canvas and runs detection
+over the whole batch in one pass. Each caller still gets its own future back.
+Images whose longer side exceeds ocr_batch_max_side (tall screenshots) are
+recognized on their own at full size instead, so the text of an image never
+depends on what else happened to be queued with it.
+
+Results are cached by image digest (see common.ocr_cache), so a repost of an
+image that was already recognized never reaches the models.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Full, Queue
+
+from common.log import logger
+from common.media import decode_image, fetch_image
+from common.ocr_cache import OcrCache, image_digest
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+
+@singleton
+class OcrEngine(object):
+    def __init__(self):
+        self.languages = conf().get("ocr_languages", ["ch_sim", "en"])
+        self.gpu = conf().get("ocr_gpu", False)
+        self.worker_count = max(1, conf().get("ocr_workers", 2))
+        self.queue_timeout = conf().get("ocr_queue_timeout", 30)
+        self.batch_size = max(1, conf().get("ocr_batch_size", 8))
+        self.batch_window = conf().get("ocr_batch_window", 0.2)
+        self.batch_max_side = conf().get("ocr_batch_max_side", 1280)
+        self.requests = Queue(maxsize=conf().get("ocr_queue_size", 64))
+        self.reader = None
+        self.reader_lock = threading.Lock()
+        self.workers = []
+        self.workers_lock = threading.Lock()
+        self.cache = None
+        self.cache_key = conf().get("ocr_cache_key", "bytes")
+        self.inflight = {}  # digest -> future, so identical images queued at the same time are recognized once
+        self.inflight_lock = threading.Lock()
+        if conf().get("ocr_cache_enabled", True):
+            path = conf().get("ocr_cache_path") or os.path.join(get_appdata_dir(), "ocr_cache.db")
+            self.cache = OcrCache(path, max_entries=conf().get("ocr_cache_max_entries", 10000), ttl=conf().get("ocr_cache_ttl", 7 * 24 * 3600))
+
+    def _get_reader(self):
+        # double-checked so concurrent first images only load the models once
+        if self.reader is None:
+            with self.reader_lock:
+                if self.reader is None:
+                    import easyocr
+
+                    logger.info("[OCR] loading easyocr models, languages={}, gpu={}".format(self.languages, self.gpu))
+                    self.reader = easyocr.Reader(self.languages, gpu=self.gpu, verbose=False)
+        return self.reader
+
+    def _ensure_workers(self):
+        if self.workers:
+            return
+        with self.workers_lock:
+            if self.workers:
+                return
+            for i in range(self.worker_count):
+                _thread = threading.Thread(target=self._work, name="ocr-worker-{}".format(i))
+                _thread.setDaemon(True)
+                _thread.start()
+                self.workers.append(_thread)
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            pending = [(image, future) for image, future in batch if future.set_running_or_notify_cancel()]
+            batchable = [(image, future) for image, future in pending if _long_side(image) <= self.batch_max_side]
+            for image, future in pending:
+                if _long_side(image) > self.batch_max_side:
+                    self._resolve(image, future)
+            if len(batchable) == 1:
+                self._resolve(*batchable[0])
+            elif batchable:
+                self._resolve_batch(batchable)
+            for _ in batch:
+                self.requests.task_done()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _resolve(self, image, future):
+        try:
+            future.set_result(self._recognize(image))
+        except Exception as e:
+            logger.exception("[OCR] recognize failed: {}".format(e))
+            future.set_exception(e)
+
+    def _resolve_batch(self, pending):
+        try:
+            texts = self._recognize_batch([image for image, _ in pending])
+        except Exception as e:
+            # one broken image must not fail the whole batch, retry them one by one
+            logger.warning("[OCR] batch of {} failed, fall back to single images: {}".format(len(pending), e))
+            for image, future in pending:
+                self._resolve(image, future)
+            return
+        logger.debug("[OCR] recognized a batch of {} images".format(len(pending)))
+        for (_, future), text in zip(pending, texts):
+            future.set_result(text)
+
+    def _recognize(self, image) -> str:
+        result = self._get_reader().readtext(_to_reader_input(image), detail=0)
+        return "".join(result)
+
+    def _recognize_batch(self, images) -> list:
+        arrays = _to_common_canvas([_to_rgb_array(image) for image in images])
+        results = self._get_reader().readtext_batched(arrays, detail=0, batch_size=len(arrays))
+        return ["".join(result) for result in results]
+
+    def submit(self, image) -> Future:
+        """
+        queue an image for recognition
+        :param image: anything easyocr accepts, e.g. a file path, url, bytes, numpy array or PIL image
+        :return: a future resolving to the recognized text
+        """
+        # decode once here, the workers and easyocr get the pixels and never download or decode again
+        image = _load_image(image)
+        if self.cache is None:
+            return self._enqueue(image, Future())
+
+        digest = image_digest(image, self.cache_key)
+        text = self.cache.get(digest)
+        future = Future()
+        if text is not None:
+            logger.debug("[OCR] cache hit, digest={}".format(digest))
+            future.set_result(text)
+            return future
+        with self.inflight_lock:
+            if digest in self.inflight:
+                return self.inflight[digest]
+            self.inflight[digest] = future
+        future.add_done_callback(self._cache_callback(digest))
+        try:
+            return self._enqueue(image, future)
+        except Full:
+            with self.inflight_lock:
+                self.inflight.pop(digest, None)
+            raise
+
+    def _enqueue(self, image, future) -> Future:
+        self._ensure_workers()
+        try:
+            self.requests.put((image, future), timeout=self.queue_timeout)
+        except Full:
+            logger.warning("[OCR] request queue is full, size={}".format(self.requests.qsize()))
+            raise
+        return future
+
+    def _cache_callback(self, digest):
+        def func(future: Future):
+            with self.inflight_lock:
+                self.inflight.pop(digest, None)
+            if not future.cancelled() and future.exception() is None:
+                self.cache.put(digest, future.result())
+
+        return func
+
+    def recognize(self, image) -> str:
+        return self.submit(image).result()
+
+    def qsize(self):
+        return self.requests.qsize()
+
+    def cache_stats(self) -> dict:
+        return self.cache.stats() if self.cache is not None else {}
+
+
+def _load_image(image):
+    """decode the image once so it can be hashed, the decoded image (PIL image or RGB array) is what gets queued for recognition"""
+    from PIL import Image
+
+    if hasattr(image, "convert") and hasattr(image, "size"):
+        return image
+    if isinstance(image, str) and image.startswith(("http://", "https://")):
+        return fetch_image(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(image)
+    if isinstance(image, str):
+        return Image.open(image)
+    return image
+
+
+def _to_reader_input(image):
+    # easyocr only understands jpeg PIL images, so hand it a plain RGB array instead
+    if hasattr(image, "convert") and hasattr(image, "size"):
+        import numpy as np
+
+        return np.array(image.convert("RGB"))
+    return image
+
+
+def _to_rgb_array(image):
+    import numpy as np
+    from easyocr.utils import reformat_input
+
+    image = _to_reader_input(image)
+    if isinstance(image, np.ndarray) and image.ndim == 3 and image.shape[2] == 3:
+        return image
+    # grayscale or rgba arrays are converted the same way easyocr itself would do it
+    img, _ = reformat_input(image)
+    return img
+
+
+def _long_side(image) -> int:
+    """longer side in pixels of a PIL image or an array"""
+    if hasattr(image, "convert") and hasattr(image, "size"):
+        return max(image.size)
+    shape = getattr(image, "shape", None)
+    return max(shape[:2]) if shape is not None else 0
+
+
+def _to_common_canvas(arrays):
+    """
+    batched detection needs images of the same shape: pad them with white to the largest width and height in
+    the batch, the pixels themselves are left as they are so a batched image reads the same as a single one
+    """
+    import numpy as np
+
+    canvas_height = max(array.shape[0] for array in arrays)
+    canvas_width = max(array.shape[1] for array in arrays)
+    canvases = []
+    for array in arrays:
+        canvas = np.full((canvas_height, canvas_width, 3), 255, dtype=np.uint8)
+        canvas[: array.shape[0], : array.shape[1]] = array
+        canvases.append(canvas)
+    return canvases
@@ -0,0 +1,138 @@
+"""
+Content-addressed cache of OCR results.
+
+Images are keyed by a digest of their decoded pixels, so the same screenshot
+reposted across Telegram, Discord and Feishu is only recognized once. Entries
+live in a small sqlite file, survive restarts, and are evicted by age (ttl)
+and by count (least recently used first). A hit refreshes the last-used time
+only once it is TOUCH_AFTER seconds old, so reads stay reads.
+
+Hits, misses and evictions are exported as ocr_cache_total and
+ocr_cache_evictions_total, the size as the ocr_cache_entries gauge.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+from common import metrics
+from common.log import logger
+
+# evictions run every this many inserts instead of on every write
+EVICT_EVERY = 64
+# a hit only writes the new accessed_at when the stored one is older than this, the lru order is that coarse
+TOUCH_AFTER = 600
+
+
+def image_digest(image, mode="bytes") -> str:
+    """
+    :param image: a PIL image or an RGB numpy array
+    :param mode: "bytes" hashes the exact RGB pixels, "perceptual" uses a 256 bit difference hash that also
+                 matches recompressed or slightly rescaled reposts
+    """
+    if not hasattr(image, "convert"):
+        import numpy as np
+
+        if mode != "perceptual" and image.ndim == 3 and image.shape[2] == 3:
+            # same digest as the PIL path below, hashed straight from the array buffer
+            sha = hashlib.sha1("{}x{}".format(image.shape[1], image.shape[0]).encode("utf-8"))
+            sha.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+            return "b:" + sha.hexdigest()
+        from PIL import Image
+
+        image = Image.fromarray(image)
+    if mode == "perceptual":
+        from PIL import Image
+
+        # difference hash: compare each pixel with its right neighbour on a 17x16 grayscale thumbnail
+        thumb = image.convert("L").resize((17, 16), Image.BILINEAR)
+        pixels = list(thumb.getdata())
+        bits = 0
+        for row in range(16):
+            for col in range(16):
+                left = pixels[row * 17 + col]
+                right = pixels[row * 17 + col + 1]
+                bits = (bits << 1) | (1 if left > right else 0)
+        return "p:{:064x}".format(bits)
+    rgb = image.convert("RGB")
+    sha = hashlib.sha1("{}x{}".format(*rgb.size).encode("utf-8"))
+    sha.update(rgb.tobytes())
+    return "b:" + sha.hexdigest()
+
+
+class OcrCache(object):
+    def __init__(self, path, max_entries=10000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.inserts = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ocr_cache (digest TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_accessed_at ON ocr_cache (accessed_at)")
+            self.conn.commit()
+            self._evict()
+        metrics.describe("ocr_cache_total", "counter", "ocr cache lookups by result, hit or miss")
+        metrics.describe("ocr_cache_evictions_total", "counter", "ocr results evicted by age or size")
+        metrics.gauge("ocr_cache_entries", lambda: len(self), "ocr results in the cache")
+        logger.info("[OCR] result cache loaded from {}, entries={}".format(path, len(self)))
+
+    def get(self, digest):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT text, created_at, accessed_at FROM ocr_cache WHERE digest = ?", (digest,)).fetchone()
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM ocr_cache WHERE digest = ?", (digest,))
+                self.conn.commit()
+                self.evictions += 1
+                metrics.inc("ocr_cache_evictions_total")
+                row = None
+            if row is None:
+                self.misses += 1
+                metrics.inc("ocr_cache_total", result="miss")
+                return None
+            if now - row[2] > TOUCH_AFTER:
+                self.conn.execute("UPDATE ocr_cache SET accessed_at = ? WHERE digest = ?", (now, digest))
+                self.conn.commit()
+            self.hits += 1
+            metrics.inc("ocr_cache_total", result="hit")
+            return row[0]
+
+    def put(self, digest, text):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO ocr_cache (digest, text, created_at, accessed_at) VALUES (?, ?, ?, ?)", (digest, text, now, now))
+            self.inserts += 1
+            if self.inserts % EVICT_EVERY == 0:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # caller holds self.lock
+        removed = 0
+        if self.ttl:
+            removed += self.conn.execute("DELETE FROM ocr_cache WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        overflow = self.conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] - self.max_entries
+        if self.max_entries and overflow > 0:
+            removed += self.conn.execute("DELETE FROM ocr_cache WHERE digest IN (SELECT digest FROM ocr_cache ORDER BY accessed_at LIMIT ?)", (overflow,)).rowcount
+        self.conn.commit()
+        self.evictions += removed
+        if removed:
+            metrics.inc("ocr_cache_evictions_total", removed)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self),
+        }
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
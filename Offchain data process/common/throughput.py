@@ -0,0 +1,35 @@
+import threading
+import time
+from collections import deque
+
+
+class ThroughputMeter:
+    """
+    Counts events and reports the rate over a sliding window, in events per second.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.total = 0
+        self.events = deque()  # (monotonic second, count)
+        self.lock = threading.Lock()
+
+    def mark(self, count=1):
+        now = int(time.monotonic())
+        with self.lock:
+            self.total += count
+            if self.events and self.events[-1][0] == now:
+                self.events[-1] = (now, self.events[-1][1] + count)
+            else:
+                self.events.append((now, count))
+            self._trim(now)
+
+    def rate(self) -> float:
+        now = int(time.monotonic())
+        with self.lock:
+            self._trim(now)
+            return sum(count for _, count in self.events) / self.window
+
+    def _trim(self, now):
+        while self.events and self.events[0][0] <= now - self.window:
+            self.events.popleft()
@@ -0,0 +1,76 @@
+"""
+Token counting with tiktoken encoders that are resolved once per model.
+
+Looking up an encoder means importing tiktoken, mapping the model name to an
+encoding and, the first time, loading (possibly downloading) its BPE ranks.
+encoding_for() does that once per model and keeps the result, warm() does it
+ahead of time in a background thread, so counting on the reply path only
+pays for the encoding itself.
+"""
+
+import threading
+
+from common.log import logger
+from config import conf
+
+DEFAULT_ENCODING = "cl100k_base"
+BATCH_THRESHOLD = 16  # count_many encodes in tiktoken's thread pool from this many texts on
+
+_encoders = {}  # model -> tiktoken Encoding
+_lock = threading.Lock()
+
+
+def encoding_for(model):
+    """the tiktoken encoding of a model, cl100k_base for models tiktoken does not know"""
+    encoding = _encoders.get(model)
+    if encoding is not None:
+        return encoding
+    with _lock:
+        encoding = _encoders.get(model)
+        if encoding is None:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logger.debug("Warning: model {} not found. Using {} encoding.".format(model, DEFAULT_ENCODING))
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            _encoders[model] = encoding
+    return encoding
+
+
+def count(text: str, model: str) -> int:
+    return len(encoding_for(model).encode(text, disallowed_special=()))
+
+
+def count_many(texts, model: str) -> list:
+    """token count of every text, in order"""
+    encoding = encoding_for(model)
+    if len(texts) >= BATCH_THRESHOLD and hasattr(encoding, "encode_batch"):
+        return [len(tokens) for tokens in encoding.encode_batch(list(texts), disallowed_special=())]
+    return [len(encoding.encode(text, disallowed_special=())) for text in texts]
+
+
+def warm(models=None, background=True):
+    """
+    resolve the encoders of models ahead of time
+    :param models: defaults to the configured model and the encodings the sessions fall back to
+    """
+    if models is None:
+        models = [m for m in [conf().get("model"), "gpt-3.5-turbo", "gpt-4"] if m]
+
+    def load():
+        for model in models:
+            try:
+                encoding_for(model)
+            except Exception as e:
+                logger.debug("[Tokens] cannot load the encoder of {}: {}".format(model, e))
+                return
+        logger.debug("[Tokens] encoders ready for {}".format(models))
+
+    if not background:
+        load()
+        return
+    _thread = threading.Thread(target=load, name="token-warmup")
+    _thread.setDaemon(True)
+    _thread.start()
@@ -159,6 +159,93 @@ available_setting = {
 
     "keyword": "", # the keyword that you want to find relevant information with in the message content
     "telegram_token": "",
+    # ocr engine shared by the discord, telegram and feishu channels
+    "ocr_languages": ["ch_sim", "en"],  # easyocr languages, the models are loaded once on the first image
+    "ocr_gpu": False,  # run easyocr on the gpu
+    "ocr_workers": 2,  # number of images recognized at the same time
+    "ocr_queue_size": 64,  # max number of images waiting for a worker
+    "ocr_queue_timeout": 30,  # seconds to wait for a free slot in the ocr queue
+    "ocr_batch_size": 8,  # max number of images recognized in one batched pass, 1 disables batching
+    "ocr_batch_window": 0.2,  # seconds a worker waits for more images before running a batch
+    "ocr_batch_max_side": 1280,  # images with a longer side above this are recognized on their own at full size instead of in a batch
+    "ocr_download_timeout": 15,  # seconds allowed to download an image before it is recognized
+    "media_max_bytes": 20 * 1024 * 1024,  # downloads above this size are aborted
+    "media_max_pixels": 50000000,  # images with more pixels are refused before they are decoded
+    "ocr_cache_enabled": True,  # cache ocr results by image digest so reposted images are recognized only once
+    "ocr_cache_key": "bytes",  # bytes: exact pixels, perceptual: difference hash that also matches recompressed reposts
+    "ocr_cache_path": "",  # sqlite file of the cache, defaults to ocr_cache.db in appdata_dir
+    "ocr_cache_max_entries": 10000,  # least recently used entries are evicted above this size
+    "ocr_cache_ttl": 7 * 24 * 3600,  # seconds an ocr result is kept
+    # relevance verdicts of the alpha keyword filter
+    "relevance_cache_enabled": True,  # reuse earlier verdicts for the same or near duplicate messages
+    "relevance_cache_ttl": 3600,  # seconds a verdict is reused
+    "relevance_cache_max_entries": 50000,  # oldest verdicts are dropped above this size
+    "relevance_similarity_threshold": 0.8,  # estimated jaccard similarity above which a message counts as a near duplicate
+    "alpha_prefilter_enabled": True,  # score messages locally and only ask the model about the ambiguous ones
+    "alpha_prefilter_rules": {},  # overrides of alpha.prefilter.DEFAULT_RULES, e.g. {"accept_words": ["$ARB"], "reject_words": ["giveaway"]}
+    "alpha_classify_batch_enabled": True,  # ask the model about several pending messages in one request
+    "alpha_classify_batch_size": 10,  # max messages in one classification request
+    "alpha_classify_max_wait": 1.0,  # seconds the oldest pending message waits for the batch to fill
+    "alpha_classify_workers": 4,  # classification requests in flight at the same time
+    "alpha_classify_min_confidence": 0.5,  # verdicts below this confidence are not cached
+    "alpha_classify_retries": 2,  # retries of a batch that got an error or unusable reply, the messages get no verdict after that
+    "alpha_classify_retry_backoff": 2.0,  # seconds every classify worker waits after a failed request, doubled per consecutive failure
+    "alpha_classify_max_backoff": 60.0,  # upper bound of that wait
+    "alpha_classify_max_fallbacks": 20,  # messages per minute asked about one by one after a batch reply skipped them
+    # collected alpha dataset, newline-delimited json segments
+    "alpha_dataset_dir": "",  # defaults to the dataset directory in appdata_dir
+    "alpha_dataset_fsync": "interval",  # always, interval or never
+    "alpha_dataset_fsync_interval": 1.0,  # seconds between two fsyncs when alpha_dataset_fsync is interval
+    "alpha_dataset_rotate_bytes": 64 * 1024 * 1024,  # start a new segment above this size, 0 disables
+    "alpha_dataset_rotate_seconds": 24 * 3600,  # start a new segment after this age, 0 disables
+    "alpha_dataset_compress": True,  # gzip rotated segments
+    "alpha_dataset_queue_size": 10000,  # producers block while this many records wait for the writer
+    "alpha_columnar_enabled": False,  # also keep arrow segments of the dataset for analytics, needs pyarrow
+    "alpha_columnar_dir": "",  # defaults to the columnar directory in alpha_dataset_dir
+    "alpha_columnar_segment_rows": 50000,  # rows per arrow segment
+    "alpha_columnar_segment_seconds": 3600,  # a segment is written at least this often while records arrive
+    "alpha_index_enabled": True,  # keep an inverted index of the dataset for the #alpha command
+    "alpha_index_path": "",  # sqlite file of the index, defaults to index.db in alpha_dataset_dir
+    "alpha_pipeline_workers": {},  # worker threads per ingestion stage, overrides alpha.pipeline.DEFAULT_WORKERS, e.g. {"ocr": 4, "classify": 16}
+    "alpha_pipeline_queue_size": 1000,  # messages waiting in front of each stage, a full stage blocks the one before it
+    "alpha_pipeline_processes": 0,  # run ocr in this many processes, each message goes to the one with the fewest in flight so messages of one chat may finish out of order; 0 keeps ocr in threads
+    "alpha_pipeline_start_method": "spawn",  # multiprocessing start method of the ocr processes
+    "alpha_pipeline_callback_workers": 4,  # threads running the callbacks of stored messages, e.g. the feishu forward
+    "metrics_port": 0,  # serve prometheus style metrics on http://0.0.0.0:{metrics_port}/metrics, 0 disables
+    "handler_pool_min_workers": 8,  # threads the message handler pool keeps when idle
+    "handler_pool_max_workers": 64,  # upper bound of the message handler pool, threads are added while messages are waiting
+    "handler_pool_idle_timeout": 60,  # seconds an idle handler thread is kept above handler_pool_min_workers
+    "handler_pool_target_wait": 0.5,  # seconds a message may wait for a handler thread before the pool grows and stops shrinking, 0 disables
+    "chat_priority_weights": {},  # share of handler turns per priority class, overrides common.fair_scheduler.DEFAULT_WEIGHTS, e.g. {"dm": 8, "bulk": 1}
+    "chat_priority_queue_limits": {"dm": 200, "mention": 200, "group": 500, "bulk": 1000},  # queued messages per priority class before new ones are dropped, 0 or missing is unlimited
+    "chat_overload_threshold": 2000,  # above this many queued messages new messages of chat_overload_shed_classes are dropped, 0 disables
+    "chat_overload_shed_classes": ["bulk", "group"],  # priority classes dropped first under overload
+    "chat_session_queue_size": 20,  # messages queued per session before chat_queue_full_policy applies, 0 is unlimited
+    "chat_global_queue_size": 5000,  # messages queued over all sessions before chat_queue_full_policy applies, 0 is unlimited
+    "chat_queue_full_policy": "drop_oldest",  # drop_oldest, coalesce (merge consecutive text from the same user, else drop_oldest) or reject
+    "chat_queue_busy_reply": "当前消息太多，请稍后再试",  # reply to a rejected message, empty to stay silent
+    "chat_queue_max_age": 300,  # seconds a message may wait in its session queue before it is dropped as stale, 0 disables
+    "token_counter_warmup": True,  # load the tiktoken encoders of the configured model in the background at startup
+    "session_store": "memory",  # where conversation sessions are kept: memory, sqlite or redis (needs the redis package)
+    "session_store_path": "",  # sqlite file of the sessions, defaults to sessions.db in appdata_dir
+    "session_store_redis_url": "redis://localhost:6379/0",  # redis server of the sessions
+    "session_store_prefix": "session:",  # prefix of the redis keys, followed by the session class and model of the bot
+    "session_store_retries": 5,  # attempts to save a session that other workers keep updating
+    "session_compaction_enabled": False,  # fold old messages of long sessions into a rolling summary in the background instead of dropping them
+    "session_compaction_ratio": 0.5,  # compact a session once its history uses this share of conversation_max_tokens
+    "session_compaction_keep_messages": 4,  # latest messages that are always kept verbatim
+    "session_compaction_model": "",  # model writing the summaries, defaults to model
+    "session_compaction_summary_tokens": 300,  # max_tokens of a summary
+    "session_compaction_workers": 2,  # threads writing summaries
+    "async_core_enabled": False,  # handle text messages as asyncio tasks on one event loop instead of one thread each
+    "async_core_executor_workers": 16,  # threads running the synchronous bots, plugins and channels under the async core
+    "async_core_http_connections": 100,  # connection pool size of the shared aiohttp session
+    "discord_ingest_workers": 4,  # discord messages handed to the ingestion engine at the same time
+    "discord_ingest_queue_size": 100,  # discord messages waiting for a worker, new messages are dropped while it is full
+    "discord_throughput_log_interval": 60,  # seconds between ingest throughput logs, 0 to disable
+    "telegram_concurrent_updates": 8,  # telegram updates handled at the same time
+    "telegram_ingest_workers": 4,  # threads handing telegram messages to the ingestion engine
+    "telegram_throughput_log_interval": 60,  # seconds between ingest throughput logs, 0 to disable, needs python-telegram-bot[job-queue]
 }
 
 
@@ -65,6 +65,11 @@ COMMANDS = {
         "alias": ["reset", "重置会话"],
         "desc": "重置会话",
     },
+    "alpha": {
+        "alias": ["alpha", "情报"],
+        "args": ["关键词", "小时数"],
+        "desc": "查询最近N小时内提到关键词的情报，默认24小时",
+    },
 }
 
 ADMIN_COMMANDS = {
@@ -321,6 +326,8 @@ class Godcmd(Plugin):
                         ok, result = True, "会话已重置"
                     else:
                         ok, result = False, "当前对话机器人不支持重置会话"
+                elif cmd == "alpha":
+                    ok, result = self.search_alpha(args)
                 logger.debug("[Godcmd] command: %s by %s" % (cmd, user))
             elif any(cmd in info["alias"] for info in ADMIN_COMMANDS.values()):
                 if isadmin:
@@ -461,6 +468,25 @@ class Godcmd(Plugin):
         else:
             return False, "认证失败"
 
+    def search_alpha(self, args) -> Tuple[bool, str]:
+        if len(args) == 0:
+            return False, "请提供要查询的关键词"
+        hours = 24
+        if len(args) > 1 and args[-1].replace(".", "", 1).isdigit():
+            hours = float(args[-1])
+            args = args[:-1]
+        query = " ".join(args)
+        try:
+            from alpha.index import format_results, search
+
+            results = search(query, hours=hours)
+        except Exception as e:
+            logger.warning("[Godcmd] alpha search failed: {}".format(e))
+            return False, "情报索引不可用"
+        if not results:
+            return True, "最近{}小时内没有提到{}的情报".format(hours, query)
+        return True, format_results(results)
+
     def get_help_text(self, isadmin=False, isgroup=False, **kwargs):
         return get_help_text(isadmin, isgroup)
 
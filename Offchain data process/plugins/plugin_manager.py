@@ -1,11 +1,14 @@
 # encoding:utf-8
 
+import asyncio
+import functools
 import importlib
 import importlib.util
 import json
 import os
 import sys
 
+from common.async_core import run_sync
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -192,6 +195,25 @@ class PluginManager:
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
         return e_context
 
+    async def async_emit_event(self, e_context: EventContext, *args, **kwargs):
+        """
+        emit_event for the async core, coroutine handlers are awaited, synchronous ones run on the async core executor
+        """
+        if e_context.event in self.listening_plugins:
+            for name in self.listening_plugins[e_context.event]:
+                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+                    instance = self.instances[name]
+                    handler = instance.handlers[e_context.event]
+                    if asyncio.iscoroutinefunction(handler):
+                        await handler(e_context, *args, **kwargs)
+                    else:
+                        await run_sync(functools.partial(handler, e_context, *args, **kwargs))
+                    if e_context.is_break():
+                        e_context["breaked_by"] = name
+                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        return e_context
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
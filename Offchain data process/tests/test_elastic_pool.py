@@ -0,0 +1,50 @@
+import threading
+import time
+
+from common.elastic_pool import ElasticThreadPool
+
+
+def test_shutdown_waits_for_the_workers():
+    pool = ElasticThreadPool(min_workers=2, max_workers=4, name="test_shutdown")
+    done = []
+    futures = [pool.submit(lambda i=i: time.sleep(0.05) or done.append(i)) for i in range(6)]
+    threads = list(pool.threads)
+    pool.shutdown(wait=True)
+    assert sorted(done) == list(range(6))
+    assert all(future.done() for future in futures)
+    assert threads and not any(_thread.is_alive() for _thread in threads)
+    assert all(_thread.daemon for _thread in threads)
+    assert pool.stats()["workers"] == 0
+
+
+def test_slow_queue_keeps_the_workers():
+    pool = ElasticThreadPool(min_workers=0, max_workers=1, idle_timeout=0.05, name="test_latency", target_wait=0.02)
+    futures = [pool.submit(time.sleep, 0.1) for _ in range(5)]
+    futures[-1].result()
+    time.sleep(0.08)  # longer than idle_timeout
+    # every task waited behind the single worker, the recent wait is above target_wait so it is not retired yet
+    assert pool.stats()["recent_wait_ms"] > 20
+    assert pool.stats()["workers"] == 1
+    deadline = time.monotonic() + 5
+    while pool.stats()["workers"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert pool.stats()["workers"] == 0  # the average decays while idle and the worker retires after all
+    pool.shutdown()
+
+
+def test_long_wait_adds_a_worker():
+    gate = threading.Event()
+    pool = ElasticThreadPool(min_workers=0, max_workers=4, name="test_grow", target_wait=0.01)
+    with pool.lock:
+        pool.idle += 1  # a worker that counts as idle but never picks anything up, e.g. stuck in its initializer
+    first = pool.submit(gate.wait)
+    time.sleep(0.05)
+    assert not first.running()  # the depth rule saw an idle worker and added no thread
+    pool.submit(gate.wait)
+    pool.submit(gate.wait)
+    time.sleep(0.1)
+    assert pool.stats()["busy"] >= 2
+    gate.set()
+    with pool.lock:
+        pool.idle -= 1
+    pool.shutdown()
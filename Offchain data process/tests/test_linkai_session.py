@@ -0,0 +1,43 @@
+import pytest
+
+import config
+from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.linkai.link_ai_bot import LinkAISession, LinkAISessionManager
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(config, "config", config.Config({"conversation_max_tokens": 300, "character_desc": "you are a bot"}))
+
+
+def test_trimming_keeps_the_token_cache_in_step():
+    manager = LinkAISessionManager(LinkAISession, model="gpt-3.5-turbo")
+    for i in range(200):
+        manager.session_reply("answer {} ".format(i) + "x" * 40, "u", query="question {}".format(i))
+    session = manager.build_session("u")
+    assert len(session.messages) < 10
+    assert len(session.message_tokens) == len(session.messages)
+    assert session.uncounted == len(session.messages)
+    assert "k" not in session.to_record()
+
+
+def test_record_with_a_stale_token_cache_is_recounted():
+    session = ChatGPTSession("u", model="wenxin")
+    session.add_query("hello")
+    record = session.to_record()
+    record["k"] = [None] * 401
+
+    loaded = ChatGPTSession("u", model="wenxin")
+    loaded.load_record(record)
+    assert loaded.message_tokens == [None, None]
+    assert loaded.calc_tokens() == len("you are a bot") + len("hello")
+
+
+def test_linkai_record_round_trip():
+    session = LinkAISession("u", model="gpt-3.5-turbo")
+    session.add_query("hello")
+    session.add_reply("hi")
+    loaded = LinkAISession("u", model="gpt-3.5-turbo")
+    loaded.load_record(session.to_record())
+    assert loaded.messages == session.messages
+    assert len(loaded.message_tokens) == 3
@@ -0,0 +1,33 @@
+from common import metrics
+from common.ocr_cache import OcrCache
+
+
+def counter(name, **labels):
+    line = name + ("{" + ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + "}" if labels else "")
+    for row in metrics.render().splitlines():
+        if row.startswith(line + " "):
+            return float(row.split()[-1])
+    return 0.0
+
+
+def test_hits_do_not_write(tmp_path):
+    cache = OcrCache(str(tmp_path / "ocr.db"))
+    cache.put("a", "text")
+    writes = cache.conn.total_changes
+    for _ in range(50):
+        assert cache.get("a") == "text"
+    assert cache.conn.total_changes == writes
+
+
+def test_lookups_and_evictions_reach_metrics(tmp_path):
+    hits, misses, evictions = counter("ocr_cache_total", result="hit"), counter("ocr_cache_total", result="miss"), counter("ocr_cache_evictions_total")
+    cache = OcrCache(str(tmp_path / "ocr.db"), max_entries=10)
+    cache.put("a", "text")
+    cache.get("a")
+    cache.get("b")
+    for i in range(64):
+        cache.put(str(i), "text")
+    assert counter("ocr_cache_total", result="hit") == hits + 1
+    assert counter("ocr_cache_total", result="miss") == misses + 1
+    assert counter("ocr_cache_evictions_total") > evictions
+    assert counter("ocr_cache_entries") == len(cache)
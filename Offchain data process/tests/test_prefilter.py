@@ -0,0 +1,84 @@
+import pytest
+
+import config
+from alpha.prefilter import ACCEPT, REJECT, UNSURE, PreFilter
+
+KEYWORD = "solana"
+
+# a feed is mostly chatter, with some spam and a few messages that matter
+CHATTER = [
+    "gm everyone",
+    "what time is the call today?",
+    "lol that is hilarious",
+    "nice one, thanks for sharing",
+    "I am going to sleep now, see you tomorrow",
+    "anyone watching the game tonight",
+    "brb grabbing coffee",
+    "can someone pin the rules message",
+    "welcome to the server, read the faq first",
+    "the weather is terrible here",
+    "早上好各位",
+    "今天天气不错",
+    "有人一起吃饭吗",
+    "哈哈哈笑死我了",
+    "晚安大家",
+    "who is hosting the spaces later",
+    "my internet keeps dropping",
+    "happy friday folks",
+    "does anyone know a good vpn",
+    "this meme is gold",
+    "ok",
+    "👍",
+]
+SPAM = [
+    "huge giveaway, dm me to claim your prize",
+    "double your btc in 24 hours, guaranteed profit",
+    "join our vip group on whatsapp for signals",
+    "免费领取USDT，加微信",
+    "稳赚不赔，专业带单",
+]
+MENTIONS = [
+    "solana is slow today",
+    "anyone using solana wallets here?",
+    "I think solana fees went up",
+    "solana是不是又卡了",
+    "is the solana meetup still on?",
+]
+RELATED = [
+    "airdrop season is coming soon I guess",
+    "is the testnet down for anyone else",
+    "snapshot date not confirmed yet",
+    "主网什么时候上线",
+]
+STRONG = [
+    "solana mainnet upgrade goes live tomorrow",
+    "contract address: 0x52908400098527886e0f7030069857d2e4169ee7",
+    "binance will list $JUP next week",
+    "solana airdrop snapshot announced for $JTO holders",
+    "合约地址已公布",
+]
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(config, "config", config.Config())
+
+
+def test_default_rules_keep_most_of_a_feed_away_from_the_model():
+    prefilter = PreFilter(KEYWORD)
+    sample = CHATTER + SPAM + MENTIONS + RELATED + STRONG
+    decisions = [prefilter.check(text) for text in sample]
+    assert decisions.count(UNSURE) / len(sample) <= 0.3
+
+
+def test_default_rules_by_kind():
+    prefilter = PreFilter(KEYWORD)
+    assert [prefilter.check(text) for text in CHATTER + SPAM] == [REJECT] * len(CHATTER + SPAM)
+    # a bare keyword mention is ambiguous, the model decides
+    assert [prefilter.check(text) for text in MENTIONS + RELATED] == [UNSURE] * len(MENTIONS + RELATED)
+    assert [prefilter.check(text) for text in STRONG] == [ACCEPT] * len(STRONG)
+
+
+def test_messages_without_signal_can_go_to_the_model():
+    prefilter = PreFilter(KEYWORD, {"reject_without_signal": False})
+    assert prefilter.check("what time is the call today?") == UNSURE
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import config
+from bot.chatgpt.chat_gpt_session import SUMMARY_HEADER, ChatGPTSession
+from bot.session_manager import SessionManager
+
+MAX_TOKENS = 1000
+
+
+def summarize(summary, messages):
+    """keeps the first word of every folded message, at most 200 characters like a bounded summary"""
+    return (summary + " " + " ".join(message["content"].split()[0] for message in messages)).strip()[-200:]
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(
+        config,
+        "config",
+        config.Config({"conversation_max_tokens": MAX_TOKENS, "session_compaction_ratio": 0.5, "session_compaction_keep_messages": 4, "character_desc": "你是一个助手"}),
+    )
+
+
+def wait_for_compaction(manager, timeout=5):
+    deadline = time.monotonic() + timeout
+    while manager.compacting and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert not manager.compacting
+
+
+def average_prompt_tokens(enabled, turns=100):
+    """average size of the prompt sent with a query over a long chat, the wenxin model counts characters"""
+    config.conf()["session_compaction_enabled"] = enabled
+    manager = SessionManager(ChatGPTSession, model="wenxin")
+    manager.summarizer = summarize
+    total = 0
+    for i in range(turns):
+        session = manager.session_query("fact{} ".format(i) + "x" * 35, "u")
+        total += session.calc_tokens()
+        manager.session_reply("answer{} ".format(i) + "y" * 50, "u")
+        wait_for_compaction(manager)
+    return total / turns, manager.build_session("u")
+
+
+def test_compaction_shrinks_long_prompts():
+    plain, _ = average_prompt_tokens(False)
+    compacted, session = average_prompt_tokens(True)
+    assert plain > 0.8 * MAX_TOKENS
+    assert compacted < 0.6 * plain
+    assert session.summary.endswith("answer97")  # the latest 4 messages stay verbatim
+    assert session.messages[0]["content"] == "你是一个助手" + SUMMARY_HEADER + session.summary
+    assert session.messages[-1]["content"].startswith("answer99")
+
+
+def test_request_snapshot_is_not_changed_by_compaction():
+    config.conf()["session_compaction_enabled"] = True
+    manager = SessionManager(ChatGPTSession, model="wenxin")
+    for i in range(4):
+        manager.session_query("q{}".format(i), "u")
+        manager.session_reply("a{}".format(i), "u")
+    session = manager.build_session("u")
+    messages = manager.snapshot(session)
+    before = [dict(message) for message in messages]
+
+    folded = session.compaction_candidates(2)
+    assert session.compact("summary", folded)
+    assert messages == before
+    assert len(session.messages) == 3
+
+
+def test_stale_summary_is_not_applied():
+    session = ChatGPTSession("u", model="wenxin")
+    session.add_query("q0")
+    session.add_reply("a0")
+    folded = session.compaction_candidates(0)
+    session.reset()
+    assert not session.compact("summary", folded)
+    assert session.summary == ""
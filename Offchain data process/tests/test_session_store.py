@@ -0,0 +1,128 @@
+import pytest
+
+import config
+from bot.session_manager import Session, SessionManager
+from bot.session_store import COMPRESS_ABOVE, RedisSessionStore, SqliteSessionStore, decode_record, encode_record
+
+
+class PlainSession(Session):
+    def __init__(self, session_id, system_prompt=None, model=None):
+        super().__init__(session_id, system_prompt)
+        self.model = model
+        self.reset()
+
+    def discard_exceeding(self, max_tokens=None, cur_tokens=None):
+        return self.calc_tokens()
+
+    def calc_tokens(self):
+        return sum(len(message["content"]) for message in self.messages)
+
+
+class OtherSession(PlainSession):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(config, "config", config.Config({"session_store_retries": 3, "character_desc": "you are a bot"}))
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_store(request, tmp_path):
+    if request.param == "sqlite":
+        return lambda namespace="": SqliteSessionStore(str(tmp_path / "sessions.db"), namespace=namespace)
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # fakeredis runs the lua compare and set with lupa
+    server = fakeredis.FakeServer()
+    return lambda namespace="": RedisSessionStore(None, namespace=namespace, client=fakeredis.FakeRedis(server=server))
+
+
+def make_manager(store, sessioncls=PlainSession):
+    manager = SessionManager(sessioncls, model="test")
+    manager.store = store
+    return manager
+
+
+def test_record_round_trip():
+    small = {"p": "系统", "m": [{"role": "user", "content": "你好"}]}
+    assert encode_record(small)[:1] == b"j"
+    assert decode_record(encode_record(small)) == small
+
+    large = {"p": "", "m": [{"role": "user", "content": "消息 {}".format(i)} for i in range(COMPRESS_ABOVE)]}
+    data = encode_record(large)
+    assert data[:1] == b"z"
+    assert decode_record(memoryview(data)) == large
+
+
+def test_save_needs_the_loaded_version(make_store):
+    store = make_store()
+    assert store.load("a") == (None, 0)
+    assert store.save("a", {"n": 1}, 0)
+    assert not store.save("a", {"n": 2}, 0)  # somebody else created it first
+    assert store.load("a") == ({"n": 1}, 1)
+    assert store.save("a", {"n": 2}, 1)
+    assert not store.save("a", {"n": 3}, 1)  # stale version
+    assert store.load("a") == ({"n": 2}, 2)
+
+
+def test_update_retries_after_a_conflict(make_store):
+    store = make_store("PlainSession:test")
+    manager = make_manager(store)
+    manager.session_query("first", "u1")
+    attempts = []
+
+    def change(session):
+        attempts.append(session.version)
+        if len(attempts) == 1:  # another worker saves in between our load and save
+            other = manager._load("u1")
+            other.add_reply("from another worker")
+            assert store.save("u1", other.to_record(), other.version)
+        session.add_query("second")
+
+    session = manager._update("u1", change)
+    assert attempts == [1, 2]
+    assert [m["content"] for m in session.messages] == ["you are a bot", "first", "from another worker", "second"]
+    assert manager._load("u1").messages == session.messages
+    assert manager._load("u1").version == 3
+
+
+def test_update_gives_up_after_the_retries(make_store):
+    manager = make_manager(make_store("PlainSession:test"))
+    manager.session_query("first", "u1")
+    attempts = []
+
+    def change(session):
+        attempts.append(session.version)
+        other = manager._load("u1")
+        other.add_reply("again")
+        manager.store.save("u1", other.to_record(), other.version)
+        session.add_query("lost")
+
+    manager._update("u1", change)
+    assert len(attempts) == 3
+    assert "lost" not in [m["content"] for m in manager._load("u1").messages]
+
+
+def test_unchanged_session_is_not_saved(make_store):
+    manager = make_manager(make_store("PlainSession:test"))
+    manager.session_query("first", "u1")
+    manager._update("u1", lambda session: False)
+    assert manager._load("u1").version == 1
+
+
+def test_namespaces_keep_bots_apart(make_store):
+    plain = make_manager(make_store("PlainSession:test"))
+    other = make_manager(make_store("OtherSession:test"), OtherSession)
+    plain.session_query("for plain", "u1")
+    other.session_query("for other", "u1")
+    assert [m["content"] for m in plain._load("u1").messages] == ["you are a bot", "for plain"]
+    assert [m["content"] for m in other._load("u1").messages] == ["you are a bot", "for other"]
+
+    other.clear_all_session()
+    assert other._load("u1").version == 0
+    assert plain._load("u1").version == 1
+
+
+def test_manager_namespace_follows_session_class_and_model():
+    assert SessionManager(PlainSession, model="test").store.namespace == "PlainSession:test"
+    assert SessionManager(OtherSession).store.namespace == "OtherSession"